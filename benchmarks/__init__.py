@@ -0,0 +1,7 @@
+"""
+Package: benchmarks
+Performance benchmarks for the Shopcart Service
+
+Every benchmark writes its results as JSON so that runs of different
+commits can be compared with python -m benchmarks.compare
+"""
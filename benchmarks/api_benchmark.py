@@ -0,0 +1,265 @@
+"""
+Shopcart API Benchmark
+
+Seeds carts made by tests/shopcart_factory.py, then drives every route of
+service/service.py from a number of concurrent workers with a configurable
+read/write mix and reports throughput and p50/p95/p99 latency as JSON.
+
+By default the requests go through the Flask test client against the
+database in DATABASE_URI (a SQLite file when it is not set), so nothing but
+the repository is needed. Pass --url to benchmark a running server instead,
+e.g. one started with gunicorn against a local MySQL or PostgreSQL
+container.
+
+Usage:
+    python -m benchmarks.api_benchmark --customers 200 --items 20 \\
+        --requests 5000 --concurrency 8 --write-ratio 0.2 --output results.json
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import contextlib
+import threading
+from collections import Counter, defaultdict
+from benchmarks.common import summarize, environment, write_report
+
+# Reads and writes with their relative weight inside their group
+READS = {
+    'index': 1,
+    'list_cart': 20,
+    'list_cart_page': 5,
+    'query_cart_price': 5,
+    'get_item': 20,
+    'cache_stats': 1,
+    'export_customers': 1,
+}
+WRITES = {
+    'create_item': 10,
+    'update_item': 10,
+    'batch_items': 4,
+    'delete_item': 4,
+    'checkout_item': 2,
+    'checkout_cart': 1,
+}
+
+
+class Workload(object):
+    """ Picks the requests of a benchmark run over the seeded carts """
+
+    def __init__(self, customers, items, first_customer=1):
+        self.customers = customers
+        self.items = items
+        self.first_customer = first_customer
+
+    def customer(self, rng):
+        return self.first_customer + rng.randrange(self.customers)
+
+    def product(self, rng):
+        return rng.randrange(self.items)
+
+    def item_body(self, rng, customer_id, product_id):
+        return {'customer_id': customer_id, 'product_id': product_id,
+                'quantity': rng.randint(1, 5), 'price': round(rng.uniform(1, 100), 2),
+                'text': 'benchmark item', 'state': 0}
+
+    def request(self, name, rng):
+        """ Returns the method, path and JSON body of an operation """
+        customer_id = self.customer(rng)
+        product_id = self.product(rng)
+        cart = '/shopcarts/{}'.format(customer_id)
+        item = '{}/{}'.format(cart, product_id)
+        if name == 'index':
+            return 'GET', '/', None
+        if name == 'list_cart':
+            return 'GET', cart, None
+        if name == 'list_cart_page':
+            return 'GET', cart + '?limit=10&fields=product_id,quantity,price', None
+        if name == 'query_cart_price':
+            return 'GET', cart + '?price={}'.format(rng.randint(1, 100)), None
+        if name == 'get_item':
+            return 'GET', item, None
+        if name == 'cache_stats':
+            return 'GET', '/cache/stats', None
+        if name == 'export_customers':
+            return 'GET', '/admin/export?customer_from={0}&customer_to={0}'.format(customer_id), None
+        if name == 'create_item':
+            return 'POST', cart + '?merge=true', self.item_body(rng, customer_id, product_id)
+        if name == 'update_item':
+            return 'PUT', item, self.item_body(rng, customer_id, product_id)
+        if name == 'batch_items':
+            operations = [{'op': 'add', 'product_id': self.items + rng.randrange(self.items),
+                           'quantity': 1, 'price': 1.5, 'text': 'benchmark item'}]
+            operations += [{'op': 'update', 'product_id': self.product(rng),
+                            'quantity': rng.randint(1, 5)} for _ in range(4)]
+            return 'PATCH', cart, operations
+        if name == 'delete_item':
+            return 'DELETE', item, None
+        if name == 'checkout_item':
+            return 'PUT', item + '/checkout', None
+        if name == 'checkout_cart':
+            return 'PUT', cart + '/checkout', None
+        raise ValueError('Unknown operation: {}'.format(name))
+
+    def seed(self, client, rng):
+        """ Creates every cart with one batch request per customer """
+        from tests.shopcart_factory import ShopcartFactory
+        for offset in range(self.customers):
+            customer_id = self.first_customer + offset
+            operations = []
+            for product_id in range(self.items):
+                item = ShopcartFactory(customer_id=customer_id, product_id=product_id,
+                                       quantity=rng.randint(1, 5),
+                                       price=round(rng.uniform(1, 100), 2))
+                operations.append({'op': 'add', 'product_id': item.product_id,
+                                   'quantity': item.quantity, 'price': item.price,
+                                   'text': item.text})
+            status_code = client.send('PATCH', '/shopcarts/{}'.format(customer_id), operations)
+            if status_code != 200:
+                raise RuntimeError('Seeding customer {} failed with {}'
+                                   .format(customer_id, status_code))
+
+
+def operation_weights(write_ratio):
+    """ Returns every operation with its probability for a share of writes """
+    weights = {}
+    for group, share in ((READS, 1.0 - write_ratio), (WRITES, write_ratio)):
+        total = float(sum(group.values()))
+        for name, weight in group.items():
+            weights[name] = share * weight / total
+    return weights
+
+
+class FlaskClient(object):
+    """ Sends requests through the Flask test client, no server needed """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def send(self, method, path, body=None):
+        return self.client.open(path, method=method, json=body).status_code
+
+
+class HttpClient(object):
+    """ Sends requests to a running server over keep-alive connections """
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def send(self, method, path, body=None):
+        return self.session.request(method, self.base_url + path, json=body).status_code
+
+
+def run_worker(make_client, workload, weights, count, seed, results):
+    """ Sends count requests and records the latency and status of each """
+    client = make_client()
+    rng = random.Random(seed)
+    names = sorted(weights)
+    probabilities = [weights[name] for name in names]
+    for name in rng.choices(names, probabilities, k=count):
+        method, path, body = workload.request(name, rng)
+        start = time.perf_counter()
+        try:
+            status_code = client.send(method, path, body)
+        except Exception as error:  # the run goes on, the error is reported
+            status_code = type(error).__name__
+        results.append((name, time.perf_counter() - start, status_code))
+
+
+def run(make_client, workload, requests, concurrency, write_ratio, seed=0, warmup=0):
+    """ Runs the benchmark and returns the report without its configuration """
+    weights = operation_weights(write_ratio)
+    if warmup:
+        run_worker(make_client, workload, weights, warmup, seed - 1, [])
+    results = []
+    threads = []
+    per_worker = [requests // concurrency + (1 if index < requests % concurrency else 0)
+                  for index in range(concurrency)]
+    for index, count in enumerate(per_worker):
+        threads.append(threading.Thread(target=run_worker,
+                                        args=(make_client, workload, weights, count,
+                                              seed + index, results)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    for name, latency, status_code in results:
+        latencies[name].append(latency)
+        statuses[name][str(status_code)] += 1
+    operations = {}
+    for name in sorted(latencies):
+        operations[name] = summarize(latencies[name])
+        operations[name]['statuses'] = dict(statuses[name])
+    total = summarize([latency for _, latency, _ in results], duration)
+    total['errors'] = sum(count for counter in statuses.values()
+                          for status_code, count in counter.items()
+                          if not status_code.isdigit() or int(status_code) >= 500)
+    total['duration_s'] = round(duration, 3)
+    return {'total': total, 'operations': operations}
+
+
+def main(argv=None):
+    """ Seeds the database, runs the benchmark and writes the JSON report """
+    parser = argparse.ArgumentParser(description='Benchmark the Shopcart API')
+    parser.add_argument('--url', help='base URL of a running server, in process when not set')
+    parser.add_argument('--customers', type=int, default=100, help='carts to seed')
+    parser.add_argument('--items', type=int, default=10, help='items in each seeded cart')
+    parser.add_argument('--first-customer', type=int, default=1)
+    parser.add_argument('--no-seed', action='store_true', help='use the carts already there')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='WARNING',
+                        help='log level of the service when it runs in process')
+    parser.add_argument('--output', default='-', help='JSON report file, stdout by default')
+    args = parser.parse_args(argv)
+    if not 0 <= args.write_ratio <= 1:
+        parser.error('--write-ratio must be between 0 and 1')
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+        database = None
+    else:
+        if 'DATABASE_URI' not in os.environ:
+            path = os.path.join(tempfile.mkdtemp(prefix='shopcart-benchmark-'), 'shopcart.db')
+            os.environ['DATABASE_URI'] = 'sqlite:///' + path
+        # the service logs to stdout, keep it apart from the report
+        with contextlib.redirect_stdout(sys.stderr):
+            from service import create_app, migrations
+            app = create_app()
+            migrations.upgrade_all()
+        logging.getLogger().setLevel(args.log_level)
+        app.logger.setLevel(args.log_level)
+        make_client = lambda: FlaskClient(app)
+        database = app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]
+
+    workload = Workload(args.customers, args.items, args.first_customer)
+    if not args.no_seed:
+        workload.seed(make_client(), random.Random(args.seed))
+    report = run(make_client, workload, args.requests, args.concurrency, args.write_ratio,
+                 args.seed, args.warmup)
+    report['benchmark'] = 'api'
+    report['config'] = {'url': args.url, 'database': database,
+                        'customers': args.customers, 'items': args.items,
+                        'requests': args.requests, 'warmup': args.warmup,
+                        'concurrency': args.concurrency, 'write_ratio': args.write_ratio,
+                        'seed': args.seed}
+    report['environment'] = environment()
+    write_report(report, args.output)
+    return 1 if report['total']['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Helpers shared by the benchmarks: latency statistics, run metadata and the
+JSON report
+"""
+import os
+import sys
+import json
+import math
+import platform
+import subprocess
+from datetime import datetime
+
+
+def percentile(sorted_values, fraction):
+    """ Returns the nearest rank percentile of an already sorted list """
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize(latencies, duration=None):
+    """ Returns the count, throughput and latency percentiles in milliseconds
+
+    Args:
+        latencies (list): the latency of every sample in seconds
+        duration (float): the wall clock seconds the samples took, used for
+            the throughput
+    """
+    values = sorted(latencies)
+    summary = {'count': len(values),
+               'mean_ms': round(1000 * sum(values) / len(values), 3) if values else 0.0,
+               'p50_ms': round(1000 * percentile(values, 0.50), 3),
+               'p95_ms': round(1000 * percentile(values, 0.95), 3),
+               'p99_ms': round(1000 * percentile(values, 0.99), 3),
+               'max_ms': round(1000 * values[-1], 3) if values else 0.0}
+    if duration is not None:
+        summary['throughput_rps'] = round(len(values) / duration, 2) if duration else 0.0
+    return summary
+
+
+def git_commit():
+    """ Returns the commit the benchmark runs on, or None outside of a git checkout """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """ Returns where the benchmark ran """
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started_at': datetime.utcnow().isoformat()}
+
+
+def write_report(report, path=None):
+    """ Writes a report as JSON to path, or to stdout when path is None or - """
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if path in (None, '-'):
+        sys.stdout.write(text + '\n')
+        return
+    with open(path, 'w') as report_file:
+        report_file.write(text + '\n')
@@ -0,0 +1,67 @@
+"""
+Benchmark Comparison
+
+Compares two JSON reports of the same benchmark, e.g. of the main branch
+and of a change, and exits with 1 when a latency got slower or the
+throughput got lower by more than the threshold.
+
+Usage:
+    python -m benchmarks.compare baseline.json results.json --threshold 0.10
+"""
+import sys
+import json
+import argparse
+
+LATENCY_KEYS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def _sections(report):
+    """ Yields the name and summary of every section of a report that has latencies """
+    if 'total' in report:
+        yield 'total', report['total']
+    for group in ('operations', 'cases'):
+        for name, summary in sorted(report.get(group, {}).items()):
+            yield '{}.{}'.format(group, name), summary
+
+
+def compare(baseline, current, threshold=0.10):
+    """ Returns the changes between two reports and which of them are regressions
+
+    A change is a (section, metric, baseline, current, relative change,
+    regression) tuple.
+    """
+    baseline_sections = dict(_sections(baseline))
+    changes = []
+    for section, summary in _sections(current):
+        before = baseline_sections.get(section)
+        if before is None:
+            continue
+        for metric in LATENCY_KEYS + ('throughput_rps',):
+            if metric not in summary or not before.get(metric):
+                continue
+            change = (summary[metric] - before[metric]) / float(before[metric])
+            worse = -change if metric == 'throughput_rps' else change
+            changes.append((section, metric, before[metric], summary[metric],
+                            round(change, 4), worse > threshold))
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative change that counts as a regression')
+    args = parser.parse_args(argv)
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        changes = compare(json.load(baseline_file), json.load(current_file), args.threshold)
+    regressions = 0
+    for section, metric, before, after, change, regression in changes:
+        regressions += regression
+        print('{:<40} {:<15} {:>12} {:>12} {:>+8.1%}{}'.format(
+            section, metric, before, after, change, '  REGRESSION' if regression else ''))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
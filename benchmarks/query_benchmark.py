@@ -0,0 +1,152 @@
+"""
+Shopcart Query Benchmark
+
+Seeds --rows items over carts of --items-per-cart items, 80% ADDED and the
+rest REMOVED or DONE, then times a page of every filter and sort of the
+listing on random carts. Every case reports the index service.query.plan()
+picked, the plan of the database and whether that plan reads the items
+through an index rather than scanning the table. The benchmark exits with
+1 when a case is not index backed.
+
+The items are written to DATABASE_URI (a SQLite file when it is not set),
+use MySQL or PostgreSQL to see their plans.
+
+Usage:
+    python -m benchmarks.query_benchmark --rows 1000000 --items-per-cart 100 \\
+        --repeat 200 --output query.json
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+from decimal import Decimal
+from benchmarks.common import summarize, environment, write_report
+
+WORDS = ('pen', 'pencil', 'paper', 'ink', 'book', 'bag', 'hat', 'cap', 'mug', 'lamp')
+# case -> state and ItemQuery arguments, the state is ADDED unless given
+CASES = {
+    'list': {},
+    'price_range': {'min_price': Decimal('20'), 'max_price': Decimal('40')},
+    'quantity_range': {'min_quantity': 3, 'max_quantity': 5},
+    'text_prefix': {'text': 'pen'},
+    'sort_price': {'sort': (('price', True),)},
+    'price_range_sort_quantity': {'max_price': Decimal('50'), 'sort': (('quantity', False),)},
+    'text_prefix_sort_price': {'text': 'b', 'sort': (('price', False), ('quantity', True))},
+    'done_items': {'state': 2},
+    'all_states': {'state': None},
+}
+
+
+def seed(rows, items_per_cart, batch_size=10000, seed_value=1):
+    """ Writes rows items in batches and returns the number of carts """
+    from service.models import DB, Shopcart
+    generator = random.Random(seed_value)
+    table = Shopcart.__table__
+    batch = []
+    for row in range(rows):
+        roll = generator.random()
+        batch.append({'customer_id': row // items_per_cart + 1,
+                      'product_id': row % items_per_cart + 1,
+                      'quantity': generator.randint(1, 9),
+                      'price': Decimal(generator.randint(100, 10000)) / 100,
+                      'text': '{} {}'.format(generator.choice(WORDS), row),
+                      'state': 0 if roll < 0.8 else 1 if roll < 0.9 else 2})
+        if len(batch) == batch_size:
+            DB.session.execute(table.insert(), batch)
+            DB.session.commit()
+            batch = []
+    if batch:
+        DB.session.execute(table.insert(), batch)
+        DB.session.commit()
+    return (rows + items_per_cart - 1) // items_per_cart
+
+
+def explain(statement):
+    """ Returns the plan of a statement and whether it reads the items through an index """
+    from service.models import DB
+    dialect = DB.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if dialect.name == 'sqlite':
+        steps = [row[-1] for row in DB.session.execute('EXPLAIN QUERY PLAN ' + sql)]
+        # SCAN shopcart reads every row, also when it is USING an index
+        return steps, not any(step.startswith('SCAN shopcart') for step in steps)
+    if dialect.name == 'mysql':
+        rows = [dict(row) for row in DB.session.execute('EXPLAIN ' + sql)]
+        return ([{name: row[name] for name in ('table', 'type', 'key', 'rows', 'Extra')}
+                 for row in rows],
+                all(row['type'] not in ('ALL', 'index') and row['key'] for row in rows))
+    steps = [row[0] for row in DB.session.execute('EXPLAIN ' + sql)]
+    return steps, not any('Seq Scan' in step for step in steps)
+
+
+def run(carts, repeat, limit=20, cases=None, seed_value=1):
+    """ Times a page of every case on random carts and explains its query """
+    from service.models import DB, Shopcart
+    from service.query import ItemQuery
+    generator = random.Random(seed_value)
+    results = {}
+    for name, arguments in sorted((cases or CASES).items()):
+        arguments = dict(arguments)
+        state = arguments.pop('state', 0)
+        item_query = ItemQuery(**arguments)
+        statement, index = Shopcart.page_query(generator.randint(1, carts), limit, state=state,
+                                               item_query=item_query)
+        plan, index_backed = explain(statement.statement)
+        latencies = []
+        for _ in range(repeat):
+            customer_id = generator.randint(1, carts)
+            started = time.perf_counter()
+            Shopcart.find_page(customer_id, limit, state=state, item_query=item_query)
+            latencies.append(time.perf_counter() - started)
+            DB.session.remove()
+        summary = summarize(latencies)
+        summary.update(index=index, plan=plan, index_backed=index_backed)
+        results['{}.page'.format(name)] = summary
+    return results
+
+
+def main(argv=None):
+    """ Seeds the items, measures every query and writes the JSON report """
+    parser = argparse.ArgumentParser(description='Benchmark the filters and sorts of listings')
+    parser.add_argument('--rows', type=int, default=1000000, help='items to seed')
+    parser.add_argument('--items-per-cart', type=int, default=100, help='items of every cart')
+    parser.add_argument('--repeat', type=int, default=200, help='pages timed per case')
+    parser.add_argument('--limit', type=int, default=20, help='items per page')
+    parser.add_argument('--output', default='-', help='JSON report file, stdout by default')
+    args = parser.parse_args(argv)
+
+    if 'DATABASE_URI' not in os.environ:
+        path = os.path.join(tempfile.mkdtemp(prefix='shopcart-benchmark-'), 'shopcart.db')
+        os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    # the service logs to stdout, keep it apart from the report
+    with contextlib.redirect_stdout(sys.stderr):
+        from service import create_app, migrations
+        app = create_app()
+        migrations.upgrade_all()
+    app.logger.setLevel('WARNING')
+
+    with app.app_context():
+        started = time.perf_counter()
+        carts = seed(args.rows, args.items_per_cart)
+        sys.stderr.write('Seeded {} items in {:.1f} s\n'.format(args.rows,
+                                                                 time.perf_counter() - started))
+        cases = run(carts, args.repeat, args.limit)
+    for name, summary in sorted(cases.items()):
+        sys.stderr.write('{:<36} {:>10.3f} ms p50 {:>10.3f} ms p95  {} {}\n'.format(
+            name, summary['p50_ms'], summary['p95_ms'], summary['index'],
+            'index' if summary['index_backed'] else 'SCAN'))
+    report = {'benchmark': 'query',
+              'cases': cases,
+              'config': {'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+                         'rows': args.rows, 'items_per_cart': args.items_per_cart,
+                         'repeat': args.repeat, 'limit': args.limit},
+              'environment': environment()}
+    write_report(report, args.output)
+    return 0 if all(summary['index_backed'] for summary in cases.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+"""
+Shopcart Serialization Benchmark
+
+Seeds one cart per size and measures the CPU time it takes to read the
+whole cart and turn it into the JSON of the listing, per item, three ways:
+
+- orm: loads Shopcart objects, calls serialize() on each and marshals and
+  dumps the dicts with flask-restplus, the way listings used to be built
+- marshal: selects the columns with Shopcart.find_page() and marshals and
+  dumps the dicts with flask-restplus
+- direct: selects the columns with Shopcart.find_page() and writes the JSON
+  with service.encoding.encode_items(), what the listing does now
+
+The cases of the report can be compared with benchmarks.compare.
+
+Usage:
+    python -m benchmarks.serialization_benchmark --sizes 10,100,1000 --repeat 50 \\
+        --output serialization.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+from decimal import Decimal
+from benchmarks.common import summarize, environment, write_report
+
+METHODS = ('orm', 'marshal', 'direct')
+
+
+def seed_cart(customer_id, size):
+    """ Adds size items to the cart of a customer in one transaction """
+    from service.models import DB, Shopcart
+    DB.session.add_all(Shopcart(customer_id=customer_id, product_id=product_id, quantity=2,
+                                price=Decimal(product_id % 10000) / 100,
+                                text='item "{}" é'.format(product_id), state=0)
+                       for product_id in range(size))
+    DB.session.commit()
+
+
+def serializers():
+    """ Returns a function for every method that returns the JSON of a cart """
+    from flask_restplus import marshal
+    from service.models import DB, Shopcart, SHOPCART_FIELDS
+    from service.service import shopcart_model
+    from service.encoding import encode_items
+
+    def orm(customer_id):
+        items = [item.serialize() for item in Shopcart.find_by_customer_id(customer_id)]
+        return json.dumps(marshal(items, shopcart_model))
+
+    def marshalled(customer_id):
+        items, _ = Shopcart.find_page(customer_id)
+        return json.dumps(marshal(items, shopcart_model))
+
+    def direct(customer_id):
+        items, _ = Shopcart.find_page(customer_id)
+        return encode_items(items, SHOPCART_FIELDS)
+
+    def session_cleared(serialize):
+        def run(customer_id):
+            try:
+                return serialize(customer_id)
+            finally:
+                DB.session.remove()
+        return run
+
+    return {'orm': session_cleared(orm), 'marshal': session_cleared(marshalled),
+            'direct': session_cleared(direct)}
+
+
+def measure(serialize, customer_id, size, repeat, warmup=3):
+    """ Returns the latency summary and the CPU microseconds per item of a method """
+    for _ in range(warmup):
+        serialize(customer_id)
+    latencies = []
+    cpu = 0.0
+    for _ in range(repeat):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        serialize(customer_id)
+        cpu += time.process_time() - cpu_started
+        latencies.append(time.perf_counter() - started)
+    summary = summarize(latencies)
+    summary['cpu_us_per_item'] = round(1e6 * cpu / (repeat * size), 3)
+    return summary
+
+
+def run(sizes, repeat, methods=METHODS):
+    """ Seeds a cart of every size and measures every method on it """
+    functions = serializers()
+    cases = {}
+    for index, size in enumerate(sizes):
+        customer_id = index + 1
+        seed_cart(customer_id, size)
+        outputs = {method: json.loads(functions[method](customer_id)) for method in methods}
+        if any(len(output) != size for output in outputs.values()):
+            raise RuntimeError('A method did not return the {} items of the cart'.format(size))
+        for method in methods:
+            cases['{}_items.{}'.format(size, method)] = measure(functions[method],
+                                                                customer_id, size, repeat)
+    return cases
+
+
+def main(argv=None):
+    """ Measures the serialization of carts of every size and writes the JSON report """
+    parser = argparse.ArgumentParser(description='Benchmark the serialization of cart listings')
+    parser.add_argument('--sizes', default='10,100,1000', help='comma separated cart sizes')
+    parser.add_argument('--methods', default=','.join(METHODS),
+                        help='comma separated methods to run')
+    parser.add_argument('--repeat', type=int, default=50, help='listings timed per case')
+    parser.add_argument('--output', default='-', help='JSON report file, stdout by default')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    methods = [method.strip() for method in args.methods.split(',') if method.strip()]
+    unknown = set(methods) - set(METHODS)
+    if unknown:
+        parser.error('unknown methods: {}'.format(', '.join(sorted(unknown))))
+
+    if 'DATABASE_URI' not in os.environ:
+        path = os.path.join(tempfile.mkdtemp(prefix='shopcart-benchmark-'), 'shopcart.db')
+        os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    # the service logs to stdout, keep it apart from the report
+    with contextlib.redirect_stdout(sys.stderr):
+        from service import create_app, migrations
+        app = create_app()
+        migrations.upgrade_all()
+    app.logger.setLevel('WARNING')
+
+    with app.app_context():
+        cases = run(sizes, args.repeat, methods)
+    for name, summary in sorted(cases.items()):
+        sys.stderr.write('{:<24} {:>10.3f} us/item {:>10.3f} ms p50\n'.format(
+            name, summary['cpu_us_per_item'], summary['p50_ms']))
+    report = {'benchmark': 'serialization',
+              'cases': cases,
+              'config': {'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+                         'sizes': sizes, 'methods': methods, 'repeat': args.repeat},
+              'environment': environment()}
+    write_report(report, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
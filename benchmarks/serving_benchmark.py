@@ -0,0 +1,156 @@
+"""
+Shopcart Serving Benchmark
+
+Runs the API benchmark against gunicorn serving the service with sync
+workers and with gevent workers, one after the other on the same database,
+and reports both runs side by side. Each mode seeds its own carts so that
+both runs start from the same data.
+
+The service talks to DATABASE_URI (a SQLite file when it is not set). Use a
+mysql+pymysql database to see what gevent workers do while requests wait
+on the database. SQLite queries block the gevent worker like any driver
+written in C, ibm_db of the Db2 deployment and psycopg2 included, so the
+report tells whether the driver was cooperative.
+
+Usage:
+    python -m benchmarks.serving_benchmark --sync-workers 4 --gevent-workers 1 \\
+        --requests 5000 --concurrency 200 --output serving.json
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from benchmarks import api_benchmark
+from benchmarks.common import environment, write_report
+from benchmarks.compare import compare
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the drivers gevent workers wait on cooperatively, as in gunicorn.conf.py
+COOPERATIVE_DRIVERS = ('mysql+pymysql',)
+MODES = ('sync', 'gevent')
+
+
+def start_server(worker_class, workers, port, worker_connections=1000, env=None):
+    """ Starts gunicorn serving the service and returns its process """
+    server_env = dict(os.environ if env is None else env,
+                      PORT=str(port),
+                      WEB_CONCURRENCY=str(workers),
+                      GUNICORN_WORKER_CLASS=worker_class,
+                      GUNICORN_WORKER_CONNECTIONS=str(worker_connections),
+                      LOG_LEVEL='WARNING')
+    # gunicorn 19 cannot be run with -m
+    return subprocess.Popen([sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+                             '--config', 'gunicorn.conf.py', 'service:create_app()'],
+                            cwd=ROOT, env=server_env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(url, process, timeout=30.0, interval=0.2):
+    """ Waits until the server answers its health check, checking every interval seconds """
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited with {}'.format(process.returncode))
+        try:
+            if requests.get(url + '/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    raise RuntimeError('The server did not start within {} seconds'.format(timeout))
+
+
+def stop_server(process, timeout=30.0):
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_mode(mode, workers, args, first_customer):
+    """ Serves the service in one mode and returns its API benchmark report """
+    url = 'http://127.0.0.1:{}'.format(args.port)
+    process = start_server(mode, workers, args.port, args.worker_connections)
+    try:
+        wait_until_ready(url, process)
+        make_client = lambda: api_benchmark.HttpClient(url)
+        workload = api_benchmark.Workload(args.customers, args.items, first_customer)
+        workload.seed(make_client(), random.Random(args.seed))
+        report = api_benchmark.run(make_client, workload, args.requests, args.concurrency,
+                                   args.write_ratio, args.seed, args.warmup)
+    finally:
+        stop_server(process)
+    report['server'] = {'worker_class': mode, 'workers': workers,
+                        'worker_connections': args.worker_connections}
+    return report
+
+
+def main(argv=None):
+    """ Benchmarks every serving mode and writes the JSON report """
+    parser = argparse.ArgumentParser(description='Benchmark sync and gevent gunicorn workers')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='comma separated worker classes to run, in order')
+    parser.add_argument('--sync-workers', type=int, default=4)
+    parser.add_argument('--gevent-workers', type=int, default=1)
+    parser.add_argument('--worker-connections', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--customers', type=int, default=100, help='carts to seed per mode')
+    parser.add_argument('--items', type=int, default=10, help='items in each seeded cart')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default='-', help='JSON report file, stdout by default')
+    args = parser.parse_args(argv)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error('unknown modes: {}'.format(', '.join(sorted(unknown))))
+
+    if 'DATABASE_URI' not in os.environ:
+        path = os.path.join(tempfile.mkdtemp(prefix='shopcart-benchmark-'), 'shopcart.db')
+        os.environ['DATABASE_URI'] = 'sqlite:///' + path
+    # create the tables before the workers start
+    with contextlib.redirect_stdout(sys.stderr):
+        from service import create_app, migrations
+        app = create_app()
+        migrations.upgrade_all()
+    workers = {'sync': args.sync_workers, 'gevent': args.gevent_workers}
+    driver = app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]
+    if 'gevent' in modes and driver not in COOPERATIVE_DRIVERS:
+        sys.stderr.write('The {} driver blocks gevent workers, use a mysql+pymysql '
+                         'DATABASE_URI to measure them\n'.format(driver))
+
+    reports = {}
+    for index, mode in enumerate(modes):
+        sys.stderr.write('Benchmarking {} workers\n'.format(mode))
+        reports[mode] = run_mode(mode, workers[mode], args, 1 + index * args.customers)
+    if len(modes) > 1:
+        for section, metric, before, after, change, _ in compare(reports[modes[0]],
+                                                                 reports[modes[-1]], 0):
+            sys.stderr.write('{:<40} {:<15} {:>12} {:>12} {:>+8.1%}\n'.format(
+                section, metric, before, after, change))
+
+    report = {'benchmark': 'serving',
+              'modes': reports,
+              'config': {'database': driver,
+                         'cooperative_driver': driver in COOPERATIVE_DRIVERS,
+                         'modes': modes, 'customers': args.customers, 'items': args.items,
+                         'requests': args.requests, 'warmup': args.warmup,
+                         'concurrency': args.concurrency, 'write_ratio': args.write_ratio,
+                         'seed': args.seed},
+              'environment': environment()}
+    write_report(report, args.output)
+    return 1 if any(mode['total']['errors'] for mode in reports.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Shopcart Startup Benchmark
+
+Starts the service in fresh processes and reports how long it takes to
+import it, to answer the first request and to answer the one after, with
+the schema upgraded on start (DB_AUTO_MIGRATE=true, what every worker used
+to do) and without. Then starts gunicorn with and without --preload and
+reports how long it takes until /health answers.
+
+The schema is created once with python -m service.migrations before the
+runs. The service talks to DATABASE_URI (a SQLite file when it is not set),
+use the production database to see what schema upgrades cost over the
+network.
+
+Usage:
+    python -m benchmarks.startup_benchmark --repeat 10 --gunicorn-workers 4 \\
+        --output startup.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from benchmarks import serving_benchmark
+from benchmarks.common import summarize, environment, write_report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_MODES = {'migrate': 'true', 'no_migrate': 'false'}
+GUNICORN_MODES = {'preload': 'true', 'no_preload': 'false'}
+
+# run in a fresh interpreter, writes its timings to the file named by argv[1]
+PROBE = '''
+import sys, json, time
+started = time.perf_counter()
+from service import create_app
+app = create_app()
+imported = time.perf_counter()
+client = app.test_client()
+status = client.get('/shopcarts/1').status_code
+first = time.perf_counter()
+client.get('/shopcarts/1')
+second = time.perf_counter()
+with open(sys.argv[1], 'w') as timings:
+    json.dump({'import': imported - started, 'first_request': first - imported,
+               'second_request': second - first, 'status': status}, timings)
+'''
+
+
+def probe(env):
+    """ Starts the service in a new interpreter and returns its timings in seconds """
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', PROBE, path], cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings = {'process': time.perf_counter() - started}
+        with open(path) as timings_file:
+            timings.update(json.load(timings_file))
+    finally:
+        os.remove(path)
+    if timings.pop('status') != 200:
+        raise RuntimeError('The first request of the service failed')
+    return timings
+
+
+def run_imports(repeat, env):
+    """ Returns the summaries of the startup timings of every import mode """
+    cases = {}
+    for mode, migrate in IMPORT_MODES.items():
+        samples = [probe(dict(env, DB_AUTO_MIGRATE=migrate)) for _ in range(repeat)]
+        for name in ('import', 'first_request', 'second_request', 'process'):
+            cases['{}.{}'.format(mode, name)] = summarize([sample[name] for sample in samples])
+    return cases
+
+
+def time_to_ready(preload, workers, port, env):
+    """ Returns the seconds gunicorn takes until /health answers """
+    started = time.perf_counter()
+    process = serving_benchmark.start_server('sync', workers, port,
+                                             env=dict(env, GUNICORN_PRELOAD=preload))
+    try:
+        serving_benchmark.wait_until_ready('http://127.0.0.1:{}'.format(port), process,
+                                           timeout=60, interval=0.01)
+        return time.perf_counter() - started
+    finally:
+        serving_benchmark.stop_server(process)
+
+
+def run_gunicorn(repeat, workers, port, env):
+    """ Returns the summaries of the time to ready of gunicorn with and without preload """
+    return {'gunicorn_{}.ready'.format(mode): summarize([time_to_ready(preload, workers, port, env)
+                                                        for _ in range(repeat)])
+            for mode, preload in GUNICORN_MODES.items()}
+
+
+def main(argv=None):
+    """ Measures the startup of the service and writes the JSON report """
+    parser = argparse.ArgumentParser(description='Benchmark the startup of the service')
+    parser.add_argument('--repeat', type=int, default=10, help='starts measured per mode')
+    parser.add_argument('--gunicorn-workers', type=int, default=4,
+                        help='workers of the gunicorn runs, 0 to skip them')
+    parser.add_argument('--port', type=int, default=5056)
+    parser.add_argument('--output', default='-', help='JSON report file, stdout by default')
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    if 'DATABASE_URI' not in env:
+        path = os.path.join(tempfile.mkdtemp(prefix='shopcart-benchmark-'), 'shopcart.db')
+        env['DATABASE_URI'] = 'sqlite:///' + path
+    subprocess.run([sys.executable, '-m', 'service.migrations'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    cases = run_imports(args.repeat, env)
+    if args.gunicorn_workers:
+        cases.update(run_gunicorn(args.repeat, args.gunicorn_workers, args.port, env))
+    for name, summary in sorted(cases.items()):
+        sys.stderr.write('{:<32} {:>10.1f} ms p50 {:>10.1f} ms p95\n'.format(
+            name, summary['p50_ms'], summary['p95_ms']))
+    report = {'benchmark': 'startup',
+              'cases': cases,
+              'config': {'database': env['DATABASE_URI'].split(':', 1)[0],
+                         'repeat': args.repeat, 'gunicorn_workers': args.gunicorn_workers},
+              'environment': environment()}
+    write_report(report, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Gunicorn configuration for the Shopcart Service
+
+Points prometheus_client at a directory shared by all workers so that
+/metrics reports the samples of every worker, and removes the samples of
+workers that exit.
+
+GUNICORN_WORKER_CLASS=gevent serves every request of a worker from its own
+greenlet instead of blocking the worker, so one process holds up to
+GUNICORN_WORKER_CONNECTIONS requests at once while they wait on the
+database. The worker patches the standard library before the service is
+imported, which makes PyMySQL and requests cooperative; drivers written in
+C (sqlite3, ibm_db, psycopg2) still block the whole worker, so a gevent
+worker on them serves one query at a time, no better than a sync worker
+and with fewer processes. The workers stay sync unless asked otherwise,
+and gunicorn warns at start when gevent workers talk to a database whose
+driver blocks them, e.g. the Db2 database of manifest.yml. WEB_CONCURRENCY
+sets the number of workers.
+
+Sync workers are forked from a master that already imported the service
+(GUNICORN_PRELOAD), so a worker starts without importing anything and
+shares the pages of the code and the static files with the master until it
+writes to them. gevent must patch the standard library before the service
+is imported, so gevent workers import it themselves unless GUNICORN_PRELOAD
+is set. Code changes need a restart rather than a HUP when preloading.
+"""
+import os
+import shutil
+import tempfile
+
+# the database drivers that the sockets patched by gevent make cooperative
+COOPERATIVE_DRIVERS = ('mysql+pymysql',)
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+loglevel = 'info'
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+preload_app = os.getenv('GUNICORN_PRELOAD',
+                        str(worker_class == 'sync')).lower() in ('true', '1', 'yes')
+
+# must be set before the workers import prometheus_client
+os.environ.setdefault('prometheus_multiproc_dir',
+                      os.path.join(tempfile.gettempdir(), 'shopcart-metrics'))
+
+
+def database_driver():
+    """ Returns the driver of the database the service uses, as in its URI """
+    if 'VCAP_SERVICES' in os.environ:
+        return 'db2'
+    return os.getenv('DATABASE_URI', 'mysql+pymysql://').split(':', 1)[0]
+
+
+def on_starting(server):
+    """ Removes the samples left over by an earlier run """
+    path = os.environ['prometheus_multiproc_dir']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    if worker_class == 'gevent' and database_driver() not in COOPERATIVE_DRIVERS:
+        server.log.warning('The %s driver blocks gevent workers, every query stops the other '
+                           'requests of its worker. Use sync workers or mysql+pymysql',
+                           database_driver())
+
+
+def post_worker_init(worker):
+    """ Gives a worker forked from the preloaded service its own log thread and connections """
+    if preload_app:
+        from service import after_fork
+        after_fork()
+
+
+def child_exit(server, worker):
+    """ Removes the live gauge samples of a worker that exited """
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,155 @@
+"""
+Static Assets
+
+Every file under service/static is read once at startup and fingerprinted
+with the MD5 digest of its content. index.html links to the fingerprinted
+URLs, e.g. static/js/rest_api.0f3c2a91b7d4.js, which are served with
+Cache-Control: public, max-age=STATIC_MAX_AGE, immutable since a changed
+file gets a new URL. The index and the plain URLs are served with
+Cache-Control: no-cache and revalidated by their ETag.
+
+Text files of COMPRESS_MIN_SIZE bytes or more are compressed with every
+encoding of service.compression at the highest level. That is slow for
+brotli, so the compressed files are kept in STATIC_CACHE_DIR by digest and
+the workers of a deploy only compress them once between them.
+"""
+import os
+import re
+import logging
+import hashlib
+import mimetypes
+import posixpath
+import tempfile
+from flask import abort, current_app, request
+from service import compression
+
+logger = logging.getLogger('flask.app')
+
+STATIC_LINK = re.compile(r'''(?P<attribute>(?:href|src)\s*=\s*["'])static/(?P<name>[^"'?#]+)''')
+
+
+class Asset(object):
+    """ A static file with its fingerprint and compressed copies """
+
+    def __init__(self, name, data, mimetype, encoded=None):
+        self.name = name
+        self.data = data
+        self.mimetype = mimetype
+        self.digest = hashlib.md5(data).hexdigest()
+        self.encoded = encoded or {}
+
+    @property
+    def fingerprinted_name(self):
+        root, extension = posixpath.splitext(self.name)
+        return '{}.{}{}'.format(root, self.digest[:12], extension)
+
+
+class StaticAssets(object):
+    """ The static files of the app by name and by fingerprinted name """
+
+    def __init__(self, assets=(), max_age=31536000):
+        self.files = {asset.name: asset for asset in assets}
+        self.fingerprints = {asset.fingerprinted_name: asset for asset in assets}
+        self.max_age = max_age
+
+    @classmethod
+    def build(cls, folder, min_size=1024, max_age=31536000, cache_dir=None):
+        """ Reads, fingerprints and compresses every file of a folder
+
+        HTML files are read last, with their links to the other files
+        replaced by fingerprinted links.
+        """
+        names = []
+        for root, _, files in os.walk(folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                names.append(os.path.relpath(path, folder).replace(os.sep, '/'))
+        names.sort(key=lambda name: (name.endswith('.html'), name))
+        assets = cls(max_age=max_age)
+        for name in names:
+            with open(os.path.join(folder, name), 'rb') as asset_file:
+                data = asset_file.read()
+            mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if mimetype == 'text/html':
+                data = assets.link(data.decode('utf-8')).encode('utf-8')
+            asset = Asset(name, data, mimetype)
+            if compression.compressible(mimetype) and len(data) >= min_size:
+                asset.encoded = {encoding: _compressed(asset, encoding, cache_dir)
+                                 for encoding in compression.encodings()}
+            assets.add(asset)
+        return assets
+
+    def add(self, asset):
+        self.files[asset.name] = asset
+        self.fingerprints[asset.fingerprinted_name] = asset
+
+    def url(self, name):
+        """ Returns the fingerprinted URL of a file, relative to the index """
+        asset = self.files.get(name)
+        return 'static/' + (asset.fingerprinted_name if asset is not None else name)
+
+    def link(self, html):
+        """ Returns html with its links to static files replaced by fingerprinted links """
+        return STATIC_LINK.sub(lambda match: match.group('attribute') +
+                               self.url(match.group('name')), html)
+
+    def send(self, name):
+        """ Returns the response of a file by name or fingerprinted name, 404 if unknown """
+        asset = self.fingerprints.get(name)
+        immutable = asset is not None
+        if asset is None:
+            asset = self.files.get(name)
+        if asset is None:
+            abort(404)
+        encoding = compression.negotiate(request.accept_encodings, list(asset.encoded))
+        response = current_app.response_class(asset.encoded[encoding] if encoding
+                                              else asset.data, mimetype=asset.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if asset.encoded:
+            response.vary.add('Accept-Encoding')
+        response.set_etag(compression.encoded_etag(asset.digest, encoding))
+        if immutable:
+            response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(
+                self.max_age)
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+
+def _compressed(asset, encoding, cache_dir):
+    """ Returns an asset compressed at the highest level, from cache_dir when it is there """
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, '{}.{}'.format(asset.digest, encoding))
+        try:
+            with open(path, 'rb') as cached:
+                return cached.read()
+        except OSError:
+            pass
+    data = compression.compress(asset.data, encoding, compression.BEST_QUALITY[encoding])
+    if path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # written aside and renamed so another worker never reads half a file
+            handle, temporary = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(handle, 'wb') as cached:
+                cached.write(data)
+            os.replace(temporary, path)
+        except OSError as error:
+            logger.warning('Cannot cache the compressed %s: %s', asset.name, error)
+    return data
+
+
+def serve(filename):
+    """ Serves a static file of the app """
+    return current_app.extensions['static_assets'].send(filename)
+
+
+def init_app(app):
+    """ Builds the static files of the app and serves them instead of Flask """
+    config = app.config
+    app.extensions['static_assets'] = StaticAssets.build(
+        app.static_folder, config['COMPRESS_MIN_SIZE'], config['STATIC_MAX_AGE'],
+        config['STATIC_CACHE_DIR'])
+    app.view_functions['static'] = serve
@@ -0,0 +1,179 @@
+"""
+Cart Cache
+
+Caches the serialized items of each customer's cart so that listing a cart
+does not query and serialize every row again. Shopcart invalidates the
+entry of a customer whenever that customer's cart is written.
+
+Backends (CACHE_BACKEND):
+memory - an LRU cache with a TTL inside each worker process (default)
+redis - a Redis server shared by all workers (CACHE_REDIS_URL), needs the
+    optional redis package
+none - caching disabled
+
+The memory backend is only invalidated in the worker that handled the
+write. Entries are stored with the cart version they were read at and are
+only used while the cart is still at that version, so a worker never
+serves a stale cart, but each worker has to warm up its own cache. The
+redis backend shares one cache between all workers.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class CacheStats(object):
+    """ Hit, miss, set and invalidation counters shared by every backend """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.invalidations = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        """ Returns the counters as a dictionary """
+        lookups = self.hits + self.misses
+        return {'backend': self.backend,
+                'hits': self.hits,
+                'misses': self.misses,
+                'sets': self.sets,
+                'invalidations': self.invalidations,
+                'hit_ratio': round(float(self.hits) / lookups, 4) if lookups else 0.0}
+
+
+class NullCache(CacheStats):
+    """ A cache that never stores anything """
+    backend = 'none'
+
+    def get(self, key):
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheStats):
+    """ An in-process cache that evicts the least recently used entries
+
+    Entries expire ttl seconds after they were set.
+    """
+    backend = 'memory'
+
+    def __init__(self, maxsize=1024, ttl=30, clock=time.monotonic):
+        CacheStats.__init__(self)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._count('misses')
+                return None
+            self._entries.move_to_end(key)
+        self._count('hits')
+        return entry[1]
+
+    def set(self, key, value):
+        """ Stores a value """
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        self._count('sets')
+
+    def delete(self, key):
+        """ Invalidates a value """
+        with self._lock:
+            self._entries.pop(key, None)
+        self._count('invalidations')
+
+    def clear(self):
+        """ Invalidates every value """
+        with self._lock:
+            self._entries.clear()
+        self._count('invalidations')
+
+
+class RedisCache(CacheStats):
+    """ A cache kept in Redis, shared by every worker
+
+    Values are stored as JSON under prefix + key and expire after ttl
+    seconds. Any client with the get/set/delete/scan_iter methods of
+    redis.Redis can be used.
+    """
+    backend = 'redis'
+
+    def __init__(self, client, ttl=30, prefix='shopcart:'):
+        CacheStats.__init__(self)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """ Returns the cached value or None """
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        return json.loads(raw)
+
+    def set(self, key, value):
+        """ Stores a value """
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+        self._count('sets')
+
+    def delete(self, key):
+        """ Invalidates a value """
+        self.client.delete(self.prefix + key)
+        self._count('invalidations')
+
+    def clear(self):
+        """ Invalidates every value under the prefix """
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+        self._count('invalidations')
+
+
+def create_cache(config):
+    """ Creates the cache selected by CACHE_BACKEND in a Flask config """
+    backend = config.get('CACHE_BACKEND', 'memory')
+    ttl = config.get('CACHE_TTL', 30)
+    if backend == 'memory':
+        return LRUCache(maxsize=config.get('CACHE_MAXSIZE', 1024), ttl=ttl)
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('CACHE_BACKEND=redis needs the redis package installed')
+        return RedisCache(redis.Redis.from_url(config['CACHE_REDIS_URL']), ttl=ttl)
+    if backend == 'none':
+        return NullCache()
+    raise RuntimeError('Unknown CACHE_BACKEND: {}'.format(backend))
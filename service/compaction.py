@@ -0,0 +1,159 @@
+"""
+Cart Compaction
+
+Keeps the shopcart table down to the carts that are in use. Items that
+were removed or checked out more than COMPACTION_RETENTION_HOURS ago, and
+items left in a cart untouched for CART_ITEM_TTL_DAYS (never when it is
+0), are moved to the shopcart_history table. Each batch of
+COMPACTION_BATCH_SIZE items is moved in its own transaction, and the job
+pauses COMPACTION_PAUSE seconds between batches so it neither holds locks
+for long nor keeps the database busy:
+
+    python -m service.compaction
+    python -m service.compaction --interval 3600
+
+The second form keeps running and compacts every hour (the compactor
+process in the Procfile). The carts that lose items get their version
+bumped, and their expired items leave their summary, so cached listings
+are revalidated.
+"""
+import sys
+import time
+import logging
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, select
+from service.models import DB, Shopcart, Cart, ShopcartHistory, SHOPCART_ITEM_STAGE, _summary
+from service.shards import MOVING, each_shard
+
+logger = logging.getLogger('flask.app')
+
+ITEMS = Shopcart.__table__
+CARTS = Cart.__table__
+HISTORY = ShopcartHistory.__table__
+HISTORY_FIELDS = ('product_id', 'customer_id', 'quantity', 'price', 'text', 'state',
+                  'updated_at')
+
+
+def expired(now, ttl=None, retention=None):
+    """ Returns the condition matching the items to move to the history
+
+    Args:
+        now (datetime): the time to measure the ages from
+        ttl (timedelta): the age of ADDED items to move, none of them when None
+        retention (timedelta): the age of REMOVED and DONE items to move,
+            none of them when None
+    """
+    conditions = []
+    if retention is not None:
+        conditions.append(and_(ITEMS.c.state != SHOPCART_ITEM_STAGE['ADDED'],
+                               ITEMS.c.updated_at < now - retention))
+    if ttl is not None:
+        conditions.append(and_(ITEMS.c.state == SHOPCART_ITEM_STAGE['ADDED'],
+                               ITEMS.c.updated_at < now - ttl))
+    return or_(*conditions) if conditions else None
+
+
+def compact_batch(session, condition, after=0, batch_size=500):
+    """ Moves the next batch of items matching a condition to the history and commits
+
+    Args:
+        after (int): only items with a higher id are moved
+    Returns:
+        the ids of the items that were moved, in order
+    """
+    rows = session.execute(select([ITEMS]).where(ITEMS.c.id > after).where(condition)
+                           .order_by(ITEMS.c.id).limit(batch_size).with_for_update()).fetchall()
+    if not rows:
+        session.commit()
+        return []
+    archived_at = datetime.utcnow()
+    session.execute(HISTORY.insert(), [dict({name: row[name] for name in HISTORY_FIELDS},
+                                            item_id=row.id, archived_at=archived_at)
+                                       for row in rows])
+    ids = [row.id for row in rows]
+    session.execute(ITEMS.delete().where(ITEMS.c.id.in_(ids)))
+    changes = defaultdict(lambda: [0, 0])
+    for row in rows:
+        count, subtotal = _summary(row.state, row.quantity, row.price)
+        changes[row.customer_id][0] += count
+        changes[row.customer_id][1] += subtotal
+    for customer_id, (count, subtotal) in changes.items():
+        session.execute(CARTS.update()
+                        .where(CARTS.c.customer_id == customer_id)
+                        .where(CARTS.c.version != MOVING)
+                        .values(version=CARTS.c.version + 1,
+                                item_count=CARTS.c.item_count - count,
+                                subtotal=CARTS.c.subtotal - subtotal))
+    session.commit()
+    for customer_id in changes:
+        Shopcart.invalidate(customer_id)
+    return ids
+
+
+def compact(session, ttl=None, retention=None, batch_size=500, pause=0.1, now=None,
+            sleep=time.sleep):
+    """ Moves every expired item of the database of a session to the history
+
+    Returns:
+        the number of items that were moved
+    """
+    condition = expired(now or datetime.utcnow(), ttl, retention)
+    if condition is None:
+        return 0
+    moved, after = 0, 0
+    while True:
+        ids = compact_batch(session, condition, after, batch_size)
+        moved += len(ids)
+        if len(ids) < batch_size:
+            return moved
+        after = ids[-1]
+        sleep(pause)
+
+
+def compact_all(config, now=None, sleep=time.sleep):
+    """ Compacts every shard with the COMPACTION_* and CART_ITEM_TTL_DAYS settings """
+    ttl_days = config['CART_ITEM_TTL_DAYS']
+    moved = 0
+    for _ in each_shard(DB):
+        moved += compact(DB.session,
+                         ttl=timedelta(days=ttl_days) if ttl_days else None,
+                         retention=timedelta(hours=config['COMPACTION_RETENTION_HOURS']),
+                         batch_size=config['COMPACTION_BATCH_SIZE'],
+                         pause=config['COMPACTION_PAUSE'], now=now, sleep=sleep)
+    return moved
+
+
+def main(argv=None):
+    """ Compacts the carts with the configuration of the Flask app """
+    parser = argparse.ArgumentParser(description='Move old cart items to the history table')
+    parser.add_argument('--batch-size', type=int, help='items moved per transaction')
+    parser.add_argument('--pause', type=float, help='seconds to wait between batches')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='compact again every this many seconds, once when 0')
+    args = parser.parse_args(argv)
+
+    from service import create_app
+    app = create_app()
+    config = dict(app.config)
+    if args.batch_size is not None:
+        config['COMPACTION_BATCH_SIZE'] = args.batch_size
+    if args.pause is not None:
+        config['COMPACTION_PAUSE'] = args.pause
+    try:
+        while True:
+            try:
+                moved = compact_all(config)
+            finally:
+                DB.session.remove()
+            logger.info('Moved %s cart items to the history', moved)
+            if not args.interval:
+                return 0
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
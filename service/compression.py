@@ -0,0 +1,135 @@
+"""
+Response Compression
+
+Compresses JSON and text responses of COMPRESS_MIN_SIZE bytes or more with
+the best encoding the request accepts: br when the brotli package is
+installed, then gzip. Streamed responses such as the export are sent as
+they are, and static files are compressed ahead of time by service.assets.
+
+A compressed response gets the ETag of the uncompressed one with the
+encoding appended ("cart-7-v3-gzip"), so every encoding of a resource has
+its own strong ETag and a cache never takes the bytes of one for another.
+The service compares If-None-Match and If-Match without the suffix, as the
+ETags name a cart version whatever the encoding, and Vary: Accept-Encoding
+keeps shared caches from handing one encoding to a client that asked for
+another.
+"""
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # responses are only gzipped without it
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml',
+                      'image/svg+xml', 'text/')
+# the highest levels, used for files compressed once
+BEST_QUALITY = {'br': 11, 'gzip': 9}
+
+
+def encodings():
+    """ Returns the encodings the service can write, best first """
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encodings, available=None):
+    """ Returns the encoding of available the request accepts most, None for identity
+
+    Args:
+        accept_encodings: the Accept-Encoding header of the request, parsed
+        available (list): the encodings to choose from, best first, every
+            encoding of encodings() when None
+    """
+    best, best_quality = None, 0
+    for encoding in encodings() if available is None else available:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, quality):
+    """ Returns data compressed with an encoding
+
+    Args:
+        quality (int): the brotli quality (0-11) or the gzip level (1-9)
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=quality)
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(quality, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    raise ValueError('Unknown encoding: {}'.format(encoding))
+
+
+def encoded_etag(etag, encoding):
+    """ Returns the ETag of a representation compressed with an encoding """
+    return '{}-{}'.format(etag, encoding) if encoding else etag
+
+
+def strip_encoding(etag):
+    """ Returns an ETag without the encoding encoded_etag() appended to it """
+    for encoding in BEST_QUALITY:
+        suffix = '-' + encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def etag_matches(etags, etag):
+    """ Returns whether If-None-Match holds an ETag in any of its encodings
+
+    Args:
+        etags (ETags): the If-None-Match header of the request, parsed
+        etag (str): the ETag of the uncompressed representation
+    """
+    return etags.star_tag or etag in {strip_encoding(tag)
+                                      for tag in etags.as_set(include_weak=True)}
+
+
+def compressible(mimetype):
+    """ Returns whether content of a mimetype gets smaller when compressed """
+    return mimetype is not None and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def _compress_response(response):
+    if response.status_code == 304:
+        _echo_etag(response)
+        return response
+    if response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or \
+            not 200 <= response.status_code < 300 or response.status_code in (204, 206) or \
+            not compressible(response.mimetype):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    config = current_app.config
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+    quality = config['COMPRESS_BROTLI_QUALITY'] if encoding == 'br' else config['COMPRESS_LEVEL']
+    response.set_data(compress(data, encoding, quality))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
+
+
+def _echo_etag(response):
+    """ Answers 304 with the ETag the client holds, with its encoding """
+    etag, weak = response.get_etag()
+    if not etag or strip_encoding(etag) != etag:
+        return
+    for tag in request.if_none_match.as_set():
+        if strip_encoding(tag) == etag:
+            response.set_etag(tag, weak)
+            return
+
+
+def init_app(app):
+    """ Compresses the responses of the app the request accepts compressed """
+    app.after_request(_compress_response)
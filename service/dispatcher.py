@@ -0,0 +1,101 @@
+"""
+Order Outbox Dispatcher
+
+Delivers the orders that checkout wrote to the order outbox to the order
+service, outside of the web request. Run it next to the web process:
+
+    python -m service.dispatcher
+
+Orders are claimed in batches, sent with their idempotency key in the
+Idempotency-Key header so a retried order is never created twice, and
+retried with exponential backoff until OUTBOX_MAX_ATTEMPTS is reached.
+With shards every shard's outbox is polled in turn.
+"""
+import sys
+import logging
+import threading
+from datetime import datetime, timedelta
+from service.models import DB, OrderOutbox
+from service.shards import each_shard
+from service.order_client import OrderClient, OrderServiceError, CircuitOpenError
+
+logger = logging.getLogger('flask.app')
+
+
+def retry_time(attempts, base_delay, max_delay, now=None):
+    """ Returns when an order that failed attempts times is tried again """
+    delay = min(base_delay * (2 ** (attempts - 1)), max_delay)
+    return (now or datetime.utcnow()) + timedelta(seconds=delay)
+
+
+def dispatch_batch(client, config):
+    """ Claims one batch of due orders and delivers them
+
+    Args:
+        client (OrderClient): the client used to send the orders
+        config (dict): the OUTBOX_* settings
+    Returns:
+        the number of orders that were claimed
+    """
+    entries = OrderOutbox.claim(config['OUTBOX_BATCH_SIZE'], config['OUTBOX_LEASE_SECONDS'])
+    sent = []
+    for entry in entries:
+        try:
+            client.create_order(entry.order, headers={'Idempotency-Key': entry.idempotency_key})
+            sent.append(entry)
+        except CircuitOpenError:
+            # the rest of the batch keeps its lease and is retried after it
+            logger.warning('Order service unavailable, delivery paused')
+            break
+        except OrderServiceError as error:
+            logger.warning('Delivery of order %s failed: %s', entry.idempotency_key, error)
+            attempts = entry.attempts + 1
+            if attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+                entry.mark_failed(error)
+            else:
+                entry.mark_failed(error, retry_time(attempts, config['OUTBOX_RETRY_DELAY'],
+                                                    config['OUTBOX_MAX_RETRY_DELAY']))
+    OrderOutbox.mark_sent(sent)
+    if entries:
+        logger.info('Delivered %s of %s orders', len(sent), len(entries))
+    return len(entries)
+
+
+def run(client, config, stop_event=None):
+    """ Delivers orders until stop_event is set
+
+    Full batches are followed by the next batch right away, the outbox is
+    polled every OUTBOX_POLL_INTERVAL seconds once it is drained.
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        claimed = 0
+        try:
+            for _ in each_shard(DB):
+                claimed = max(claimed, dispatch_batch(client, config))
+        except Exception as error:
+            logger.exception('Order dispatcher failed: %s', error)
+            DB.session.rollback()
+        finally:
+            DB.session.remove()
+        if claimed < config['OUTBOX_BATCH_SIZE']:
+            stop_event.wait(config['OUTBOX_POLL_INTERVAL'])
+
+
+def main():
+    """ Runs the dispatcher with the configuration of the Flask app """
+    from service import create_app
+    app = create_app()
+    logger.info('Order dispatcher running')
+    client = OrderClient.from_config(app.config)
+    try:
+        run(client, app.config)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Item Encoding
+
+Cart listings are the largest responses of the service. Instead of building
+a dict per item and letting flask-restplus marshal and dump it again, the
+items are written straight to the JSON text of the response in one pass,
+with one encoder per field.
+
+Prices are Numeric columns and always leave the service with two decimals,
+as text in item bodies and exports and as a JSON number with the same
+digits in listings, so no price goes through a float on the way out.
+"""
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
+
+CENT = Decimal('0.01')
+
+
+def price_text(value):
+    """ Returns a price as text with two decimals, or None """
+    if value is None:
+        return None
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return str(value.quantize(CENT))
+
+
+def _integer(value):
+    return 'null' if value is None else str(int(value))
+
+
+def _price(value):
+    return 'null' if value is None else price_text(value)
+
+
+def _text(value):
+    return 'null' if value is None else encode_basestring_ascii(value)
+
+
+ITEM_ENCODERS = {
+    'id': _integer,
+    'product_id': _integer,
+    'customer_id': _integer,
+    'quantity': _integer,
+    'price': _price,
+    'text': _text,
+    'state': _integer,
+    'version': _integer,
+}
+
+
+def encode_items(items, fields):
+    """ Returns the JSON array of a list of serialized items
+
+    Fields an item does not have are written as null, like marshal() does.
+    Args:
+        items (list): the items as dicts
+        fields (list): the names of the fields to write, in order
+    """
+    encoders = [(name, '"{}":'.format(name), ITEM_ENCODERS[name]) for name in fields]
+    return '[' + ','.join(
+        '{' + ','.join(key + encode(item.get(name)) for name, key, encode in encoders) + '}'
+        for item in items) + ']'
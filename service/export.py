@@ -0,0 +1,135 @@
+"""
+Cart Export
+
+Streams shopcart rows as NDJSON or CSV for the analytics pipeline. Rows are
+read through a server side cursor EXPORT_CHUNK_SIZE rows at a time and
+written out in chunks of about EXPORT_BUFFER_SIZE characters, so memory
+stays flat however many rows are exported.
+
+The export is served by GET /admin/export and can be run from the command
+line with:
+    python -m service.export carts.csv --format csv --updated-since 2019-12-01T00:00:00
+
+The service logs to stdout, so the command line export is written to a file.
+With shards the rows of one shard follow the rows of the one before.
+"""
+import io
+import csv
+import sys
+import json
+import argparse
+from datetime import datetime
+from service.models import DB, Shopcart, SHOPCART_FIELDS
+from service.encoding import price_text
+from service.shards import each_shard
+
+EXPORT_FIELDS = SHOPCART_FIELDS + ('updated_at',)
+CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def query_rows(state=None, customer_from=None, customer_to=None, updated_since=None,
+               chunk_size=1000):
+    """ Yields the shopcart rows ordered by id, read by a streaming query per shard
+
+    Args:
+        state (int): only export items in this state
+        customer_from (int): only export customers with this id or above
+        customer_to (int): only export customers with this id or below
+        updated_since (datetime): only export items written at or after this time
+        chunk_size (int): rows fetched from the cursor at a time
+    """
+    query = DB.session.query(*[getattr(Shopcart, name) for name in EXPORT_FIELDS])
+    if state is not None:
+        query = query.filter(Shopcart.state == state)
+    if customer_from is not None:
+        query = query.filter(Shopcart.customer_id >= customer_from)
+    if customer_to is not None:
+        query = query.filter(Shopcart.customer_id <= customer_to)
+    if updated_since is not None:
+        query = query.filter(Shopcart.updated_at >= updated_since)
+    query = query.order_by(Shopcart.id) \
+        .execution_options(stream_results=True).yield_per(chunk_size)
+    for _ in each_shard(DB):
+        for row in query:
+            yield row
+
+
+def _values(row):
+    """ Returns the values of a row as JSON types """
+    values = row._asdict()
+    values['price'] = price_text(values['price'])
+    if values['updated_at'] is not None:
+        values['updated_at'] = values['updated_at'].isoformat()
+    return values
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(_values(row)) + '\n'
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        values = _values(row)
+        writer.writerow([values[name] for name in EXPORT_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def generate(rows, export_format='ndjson', buffer_size=65536):
+    """ Yields the rows formatted as NDJSON or CSV in chunks of about buffer_size characters """
+    if export_format not in CONTENT_TYPES:
+        raise ValueError('Unknown export format: {}'.format(export_format))
+    lines = _ndjson_lines(rows) if export_format == 'ndjson' else _csv_lines(rows)
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= buffer_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _timestamp(value):
+    """ Parses an ISO 8601 timestamp of the command line """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('not an ISO 8601 timestamp: {}'.format(value))
+
+
+def main(argv=None):
+    """ Writes the export to a file with the configuration of the Flask app """
+    parser = argparse.ArgumentParser(description='Export shopcart rows as NDJSON or CSV')
+    parser.add_argument('output', help='file to write the rows to')
+    parser.add_argument('--format', choices=sorted(CONTENT_TYPES), default='ndjson')
+    parser.add_argument('--state', type=int)
+    parser.add_argument('--customer-from', type=int)
+    parser.add_argument('--customer-to', type=int)
+    parser.add_argument('--updated-since', type=_timestamp)
+    args = parser.parse_args(argv)
+
+    from service import create_app
+    app = create_app()
+    with app.app_context(), open(args.output, 'w', newline='') as out:
+        rows = query_rows(args.state, args.customer_from, args.customer_to,
+                          args.updated_since, app.config['EXPORT_CHUNK_SIZE'])
+        try:
+            for chunk in generate(rows, args.format, app.config['EXPORT_BUFFER_SIZE']):
+                out.write(chunk)
+        finally:
+            DB.session.remove()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+Structured Logging
+
+Log records are put on an in-memory queue by the thread that logs them and
+written to stdout by a background listener thread, so a request never waits
+for stdout. Every record is written as one JSON object (LOG_FORMAT=json) or
+as a line of text (LOG_FORMAT=text) and carries the id of the request that
+logged it, taken from the X-Request-ID header or generated, and sent back in
+the X-Request-ID header of the response.
+
+Info and debug records can be sampled (LOG_SAMPLE_RATE) and rate limited per
+message (LOG_RATE_LIMIT records per second), warnings and errors are always
+written. Records are dropped instead of blocking when the queue is full.
+"""
+import re
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, request, has_request_context
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(module)s [%(request_id)s]: %(message)s'
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a single line JSON object """
+
+    def format(self, record):
+        entry = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'module': record.module,
+                 'message': record.getMessage(),
+                 'request_id': getattr(record, 'request_id', None)}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class RequestIdFilter(logging.Filter):
+    """ Adds the id of the current request to a record """
+
+    def filter(self, record):
+        request_id = None
+        if has_request_context():
+            request_id = g.get('request_id')
+        record.request_id = request_id or '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """ Samples info and debug records and limits how often each message is written
+
+    Args:
+        sample_rate (float): share of info and debug records that are kept
+        rate_limit (int): records of one message kept per second, 0 for no limit
+    """
+
+    def __init__(self, sample_rate=1.0, rate_limit=0, clock=time.monotonic):
+        logging.Filter.__init__(self)
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self.dropped = 0
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self._drop()
+            return False
+        if self.rate_limit:
+            # one window per message template, so the number of keys stays small
+            key = (record.name, record.msg)
+            second = int(self.clock())
+            with self._lock:
+                window, count = self._windows.get(key, (second, 0))
+                if window != second:
+                    window, count = second, 0
+                if count >= self.rate_limit:
+                    self.dropped += 1
+                    return False
+                self._windows[key] = (window, count + 1)
+        return True
+
+    def _drop(self):
+        with self._lock:
+            self.dropped += 1
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """ Puts records on the queue with their message already formatted
+
+    The message is rendered in the logging thread because the arguments can
+    change after the call returns. Records are dropped when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def request_id():
+    """ Returns the id of the current request, from its header or a new one """
+    incoming = request.headers.get(REQUEST_ID_HEADER, '')
+    if REQUEST_ID_PATTERN.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+def _start_request():
+    g.request_id = request_id()
+
+
+def _add_request_id(response):
+    if 'request_id' in g:
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+
+def init_app(app):
+    """ Gives every request of the app an id that is logged and returned """
+    app.before_request(_start_request)
+    app.after_request(_add_request_id)
+
+
+def configure(log_level=logging.INFO, log_format='json', sample_rate=1.0, rate_limit=0,
+              queue_size=10000, stream=None):
+    """ Routes every logger through a queue to a listener thread writing to stream
+
+    Calling it again replaces the handlers and the listener of the last call.
+    Returns the queue handler.
+    """
+    global _listener
+    stop()
+    output = logging.StreamHandler(stream or sys.stdout)
+    if log_format == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(queue_size)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter(sample_rate, rate_limit))
+    handler.setLevel(log_level)
+
+    root = logging.getLogger()
+    for old_handler in [h for h in root.handlers if isinstance(h, NonBlockingQueueHandler)]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(log_level)
+
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+    return handler
+
+
+def stop():
+    """ Writes out the queued records and stops the listener thread """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def forget():
+    """ Drops the listener of the parent in a forked process without stopping it
+
+    Its thread does not run in the child and its queue may have been locked
+    at the fork, so the child calls configure() again afterwards.
+    """
+    global _listener
+    _listener = None
+
+
+atexit.register(stop)
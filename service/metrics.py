@@ -0,0 +1,120 @@
+"""
+Request and Query Metrics
+
+Records, per route, the request latency, the requests in flight, the
+responses by status code and the SQL queries every request runs, and
+exposes them in the Prometheus text format on GET /metrics.
+
+A request that runs the same SQL statement METRICS_N_PLUS_ONE_THRESHOLD
+times or more is counted as an N+1 query pattern and logged.
+
+Under gunicorn every worker is a separate process. When the
+prometheus_multiproc_dir environment variable names a directory (see
+gunicorn.conf.py) the workers write their samples there and /metrics adds
+up the samples of all workers.
+"""
+import os
+import time
+import logging
+from collections import Counter as StatementCounter
+from flask import current_app, g, request, has_request_context
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, \
+    Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('flask.app')
+
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+REQUEST_LATENCY = Histogram('shopcart_http_request_duration_seconds',
+                            'Time to handle a request', ['method', 'route'])
+REQUESTS_IN_PROGRESS = Gauge('shopcart_http_requests_in_progress',
+                             'Requests being handled', ['method', 'route'],
+                             multiprocess_mode='livesum')
+RESPONSES = Counter('shopcart_http_responses_total',
+                    'Responses sent', ['method', 'route', 'status'])
+QUERIES_PER_REQUEST = Histogram('shopcart_db_queries_per_request',
+                                'SQL queries run by a request', ['route'],
+                                buckets=QUERY_BUCKETS)
+QUERY_TIME_PER_REQUEST = Histogram('shopcart_db_query_duration_per_request_seconds',
+                                   'Time a request spent running SQL queries', ['route'])
+N_PLUS_ONE_REQUESTS = Counter('shopcart_db_n_plus_one_requests_total',
+                              'Requests that ran the same SQL statement repeatedly',
+                              ['route'])
+
+
+def route_label():
+    """ Returns the route template of the request, which keeps the label set small """
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_route = route_label()
+    g.metrics_queries = 0
+    g.metrics_query_time = 0.0
+    g.metrics_statements = StatementCounter()
+    REQUESTS_IN_PROGRESS.labels(request.method, g.metrics_route).inc()
+
+
+def _record_response(response):
+    if 'metrics_start' not in g:
+        return response
+    route = g.metrics_route
+    REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - g.metrics_start)
+    RESPONSES.labels(request.method, route, str(response.status_code)).inc()
+    QUERIES_PER_REQUEST.labels(route).observe(g.metrics_queries)
+    QUERY_TIME_PER_REQUEST.labels(route).observe(g.metrics_query_time)
+    if g.metrics_statements:
+        statement, count = g.metrics_statements.most_common(1)[0]
+        if count >= current_app.config.get('METRICS_N_PLUS_ONE_THRESHOLD', 10):
+            N_PLUS_ONE_REQUESTS.labels(route).inc()
+            logger.warning('N+1 queries: %s %s ran %s times: %s',
+                           request.method, route, count, statement[:200])
+    return response
+
+
+def _end_request(error=None):
+    if 'metrics_start' in g:
+        REQUESTS_IN_PROGRESS.labels(request.method, g.metrics_route).dec()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'metrics_start' in g:
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('metrics_query_start')
+    if not starts or not has_request_context() or 'metrics_start' not in g:
+        return
+    g.metrics_queries += 1
+    g.metrics_query_time += time.perf_counter() - starts.pop()
+    g.metrics_statements[statement] += 1
+
+
+def init_app(app):
+    """ Installs the request hooks on the app and the query hooks on every engine """
+    app.before_request(_start_request)
+    app.after_request(_record_response)
+    app.teardown_request(_end_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def registry():
+    """ Returns the registry to expose, the samples of all workers in multiprocess mode """
+    if not os.environ.get('prometheus_multiproc_dir'):
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def exposition():
+    """ Returns the metrics in the Prometheus text format and its content type """
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
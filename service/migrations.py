@@ -0,0 +1,164 @@
+"""
+Schema migrations for Shopcart Service
+
+DB.create_all() only creates tables that do not exist yet, it never changes a
+table that is already there. The steps in this module bring an existing
+database up to date with the models in service.models. Every step checks the
+live schema first, so upgrade() is safe to run on every start up.
+
+The service does not touch the schema when it starts unless DB_AUTO_MIGRATE
+is set. Create or upgrade the tables of the database and of every shard
+before starting it with:
+
+    python -m service.migrations
+"""
+import sys
+import logging
+import argparse
+from datetime import datetime
+from sqlalchemy import Column, Index, Integer, MetaData, Table, and_, case, func, inspect, \
+    select, orm
+from sqlalchemy.schema import DropIndex
+from service.models import DB, Shopcart, Cart, SHOPCART_ITEM_STAGE
+
+logger = logging.getLogger('flask.app')
+
+# indexes of the Shopcart table that newer indexes made redundant
+RETIRED_INDEXES = ('ix_shopcart_customer_price',)
+
+
+def _index_names(engine, table_name):
+    """ Returns the lower cased names of the indexes that exist on a table """
+    return {index['name'].lower() for index in inspect(engine).get_indexes(table_name)
+            if index.get('name')}
+
+
+def remove_duplicate_items(engine):
+    """ Removes all but one row for every (customer_id, product_id) pair
+
+    The ADDED row is kept, so the item stays in the customer's cart, and
+    among several ADDED rows, or when none is ADDED, the row with the lowest
+    id, which is the row the service used to return from
+    find_by_customer_id_and_product_id() before the pair was made unique.
+    The ids of the removed rows are logged.
+    """
+    table = Shopcart.__table__
+    duplicated = select([table.c.customer_id, table.c.product_id]) \
+        .group_by(table.c.customer_id, table.c.product_id) \
+        .having(func.count() > 1) \
+        .alias('duplicated')
+    rows = engine.execute(
+        select([table.c.id, table.c.customer_id, table.c.product_id])
+        .select_from(table.join(duplicated,
+                                and_(table.c.customer_id == duplicated.c.customer_id,
+                                     table.c.product_id == duplicated.c.product_id)))
+        .order_by(table.c.customer_id, table.c.product_id,
+                  case([(table.c.state == SHOPCART_ITEM_STAGE['ADDED'], 0)], else_=1),
+                  table.c.id)).fetchall()
+    removed, pair = [], None
+    for row in rows:
+        if (row.customer_id, row.product_id) == pair:
+            removed.append(row.id)
+        pair = (row.customer_id, row.product_id)
+    if removed:
+        engine.execute(table.delete().where(table.c.id.in_(removed)))
+        logger.warning('Removed %s duplicate shopcart items: %s', len(removed), removed)
+    return len(removed)
+
+
+def add_missing_columns(engine, table=None):
+    """ Adds the columns declared on a model's table that are missing
+
+    Existing rows get updated_at set to now, so incremental exports pick
+    them up once after the upgrade, and version set to 1, the version
+    new items start at.
+    Args:
+        table (Table): the table to upgrade, the Shopcart table by default
+    """
+    table = Shopcart.__table__ if table is None else table
+    existing = {column['name'].lower() for column in inspect(engine).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name.lower() in existing:
+            continue
+        logger.info('Adding column %s.%s', table.name, column.name)
+        engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name, column.type.compile(dialect=engine.dialect)))
+        added.append(column.name)
+    if 'updated_at' in added:
+        engine.execute(table.update().values(updated_at=datetime.utcnow()))
+    if 'version' in added:
+        engine.execute(table.update().values(version=1))
+    return added
+
+
+def create_missing_indexes(engine):
+    """ Creates the indexes declared on the Shopcart model that are missing """
+    table = Shopcart.__table__
+    existing = _index_names(engine, table.name)
+    created = []
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name.lower() in existing:
+            continue
+        if index.unique:
+            remove_duplicate_items(engine)
+        logger.info('Creating index %s', index.name)
+        index.create(bind=engine)
+        created.append(index.name)
+    return created
+
+
+def drop_retired_indexes(engine):
+    """ Drops the indexes of RETIRED_INDEXES that are still there """
+    table = Shopcart.__table__
+    existing = _index_names(engine, table.name)
+    dropped = []
+    for name in RETIRED_INDEXES:
+        if name.lower() not in existing:
+            continue
+        logger.info('Dropping index %s', name)
+        # an index of a copy of the table, so the model does not declare it again
+        copy = Table(table.name, MetaData(), Column('customer_id', Integer))
+        engine.execute(DropIndex(Index(name, copy.c.customer_id)))
+        dropped.append(name)
+    return dropped
+
+
+def upgrade(engine):
+    """ Runs every migration step against the database """
+    logger.info('Upgrading database schema')
+    add_missing_columns(engine)
+    if add_missing_columns(engine, Cart.__table__):
+        # fill in the summaries of the carts that were there before
+        from service import summary
+        session = orm.Session(bind=engine)
+        try:
+            summary.reconcile(session)
+        finally:
+            session.close()
+    create_missing_indexes(engine)
+    drop_retired_indexes(engine)
+
+
+def upgrade_all():
+    """ Creates the missing tables and upgrades the database and every shard """
+    for engine in [DB.engine] + DB.shards.engines:
+        DB.metadata.create_all(engine)
+        upgrade(engine)
+
+
+def main(argv=None):
+    """ Upgrades the databases of the configuration of the Flask app """
+    parser = argparse.ArgumentParser(description='Create or upgrade the database schema')
+    parser.parse_args(argv)
+
+    from service import create_app
+    app = create_app()
+    with app.app_context():
+        upgrade_all()
+    logger.info('Database schema is up to date')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,30 +14,254 @@ quantity - (integer) quantity of the items
 price - (float) per item
 text - (string) description of the item
 state - (integer) ADDED(0),REMOVED(1),DONE(2)
+updated_at - (datetime) when the item was last written
+version - (integer) bumped by every write to the item; a write made by the
+    ORM from an older version fails with ItemConflictError
+
+Indexes:
+--------
+ix_shopcart_customer_product - unique (customer_id, product_id), one row per
+    product in a customer's cart; backs every single item lookup
+ix_shopcart_customer_state_price - (customer_id, state, price), backs price
+    ranges, the target price query and sorts by price
+ix_shopcart_customer_state_quantity - (customer_id, state, quantity), backs
+    quantity ranges and sorts by quantity
+ix_shopcart_customer_state_text - (customer_id, state, text), backs text
+    prefixes and sorts by text
+ix_shopcart_customer_id - (customer_id, id), backs the pages of the customer
+    listing of every state
+ix_shopcart_customer_active - (customer_id, state, id), backs the pages of the
+    customer listing of one state; on PostgreSQL and SQLite it only holds the
+    ADDED items, so listing a cart never reads its removed and checked out items
+
+Cart
+One row per customer with the version of that customer's cart
+Attributes:
+-----------
+customer_id - (integer) the customer that owns the cart
+version - (integer) bumped in the transaction of every write to the cart
+item_count - (integer) quantity of the ADDED items, kept in the same transaction
+subtotal - (decimal) price * quantity of the ADDED items, kept in the same transaction
+
+OrderOutbox
+Orders waiting to be delivered to the order service by service.dispatcher
+Attributes:
+-----------
+id - (integer) auto increment
+idempotency_key - (string) sent with the order so retries are not duplicated
+customer_id - (integer) the customer that checked out
+payload - (text) the order as JSON
+status - (integer) PENDING(0),SENT(1),FAILED(2)
+attempts - (integer) number of failed deliveries
+next_attempt_at - (datetime) the order is not delivered before this time
+claim_token - (string) the dispatcher run that is delivering the order
+last_error - (string) why the last delivery failed
+created_at - (datetime) when the order was checked out
+
+ShopcartHistory
+Items moved out of the shopcart table by service.compaction
+Attributes:
+-----------
+id - (integer) auto increment
+item_id - (integer) the id the item had in the shopcart table
+product_id, customer_id, quantity, price, text, state, updated_at - as the
+    item was when it was moved
+archived_at - (datetime) when the item was moved
+
+With DATABASE_SHARD_URIS set every model lives on the shard of its customer,
+see service.shards. The methods of a customer's cart send the session there.
 """
+import json
+import uuid
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from decimal import Decimal, InvalidOperation
+from datetime import datetime, timedelta
+from sqlalchemy import and_, case, inspect, literal_column, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.exc import StaleDataError
+from service.cache import NullCache, create_cache
+from service.encoding import price_text
+from service.pool import engine_options
+from service.query import ItemQuery, plan
+from service.replicas import ReplicaSet, RoutingSQLAlchemy, replica_read
+from service.shards import ShardSet, route, each_shard
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-DB = SQLAlchemy()
+DB = RoutingSQLAlchemy()
 SHOPCART_ITEM_STAGE = {"ADDED":0, "REMOVED":1, "DONE":2}
+SHOPCART_FIELDS = ('id', 'product_id', 'customer_id', 'quantity', 'price', 'text', 'state',
+                   'version')
+OUTBOX_STATUS = {"PENDING":0, "SENT":1, "FAILED":2}
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+class StaleVersionError(Exception):
+    """ Used when a cart was changed since the version the client has seen """
+    pass
+
+class ItemConflictError(Exception):
+    """ Used when an item was changed since the version the client has seen,
+    or a change would leave it without a quantity """
+    pass
+
+class CartMovingError(Exception):
+    """ Used when a cart is written while it is moved to another shard """
+    pass
+
+def insert_if_absent(session, table, values, key_columns):
+    """ Inserts a row in one statement unless the key is already taken
+
+    The statement is chosen by dialect so that the existence check and the
+    insert happen atomically inside the database: INSERT IGNORE on MySQL,
+    ON CONFLICT DO NOTHING on PostgreSQL, INSERT OR IGNORE on SQLite and
+    MERGE on Db2. Other databases fall back to an INSERT in a savepoint.
+
+    Args:
+        session: the session to execute the statement in
+        table (Table): the table to insert into
+        values (dict): the column values of the new row
+        key_columns (list): the names of the unique columns that identify the row
+    Returns:
+        the primary key of the new row, or None if the row already existed
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in ('db2', 'ibm_db_sa'):
+        return _merge_if_absent(session, table, values, key_columns)
+    if dialect == 'mysql':
+        statement = table.insert().values(values).prefix_with('IGNORE')
+    elif dialect == 'postgresql':
+        statement = postgresql.insert(table).values(values).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().values(values).prefix_with('OR IGNORE')
+    else:
+        try:
+            with session.begin_nested():
+                result = session.execute(table.insert().values(values))
+        except IntegrityError:
+            return None
+        return result.inserted_primary_key[0]
+    result = session.execute(statement)
+    if not result.rowcount:
+        return None
+    return result.inserted_primary_key[0]
+
+def _merge_if_absent(session, table, values, key_columns):
+    """ Db2 flavour of insert_if_absent() using MERGE ... WHEN NOT MATCHED """
+    columns = list(values)
+    statement = text(
+        'MERGE INTO {table} AS t USING (VALUES ({keys})) AS s ({key_names}) '
+        'ON {match} WHEN NOT MATCHED THEN INSERT ({names}) VALUES ({params})'.format(
+            table=table.name,
+            keys=', '.join('CAST(:{0} AS INTEGER)'.format(key) for key in key_columns),
+            key_names=', '.join(key_columns),
+            match=' AND '.join('t.{0} = s.{0}'.format(key) for key in key_columns),
+            names=', '.join(columns),
+            params=', '.join(':{0}'.format(column) for column in columns)))
+    result = session.execute(statement, values)
+    if not result.rowcount:
+        return None
+    primary_key = list(table.primary_key)[0]
+    if primary_key.name in values:
+        return values[primary_key.name]
+    return session.execute(select([primary_key]).where(
+        and_(*[table.c[key] == values[key] for key in key_columns]))).scalar()
+
+def _summary(state, quantity, price):
+    """ Returns what an item adds to the item count and the subtotal of its cart """
+    if state not in (None, SHOPCART_ITEM_STAGE['ADDED']) or quantity is None:
+        return 0, Decimal(0)
+    price = Decimal(str(price or 0)).quantize(Decimal('0.01'))
+    return int(quantity), price * int(quantity)
+
+def _product_id(operation):
+    """ Returns the product_id of a batch operation as an integer """
+    if not isinstance(operation, dict):
+        raise DataValidationError('Invalid operation: body of operation must be an object')
+    try:
+        return int(operation['product_id'])
+    except KeyError:
+        raise DataValidationError('Invalid operation: missing product_id')
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid operation: product_id must be an integer')
+
+def _positive_quantity(data):
+    """ Returns the quantity in data as an integer of at least 1 """
+    try:
+        quantity = int(data['quantity'])
+    except KeyError:
+        raise DataValidationError('Invalid shopcart item: missing quantity')
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid shopcart item: quantity must be an integer')
+    if quantity < 1:
+        raise DataValidationError('Invalid shopcart item: quantity must be at least 1')
+    return quantity
+
+def _price(data):
+    """ Returns the price in data as a Decimal of at least 0 """
+    try:
+        price = Decimal(str(data['price']))
+    except KeyError:
+        raise DataValidationError('Invalid shopcart item: missing price')
+    except InvalidOperation:
+        raise DataValidationError('Invalid shopcart item: price must be a number')
+    if not price.is_finite() or price < 0:
+        raise DataValidationError('Invalid shopcart item: price must be a number of at least 0')
+    return price
+
+def _commit_item(item):
+    """ Commits a write of an item, raises ItemConflictError if another one came first """
+    try:
+        DB.session.commit()
+    except StaleDataError:
+        DB.session.rollback()
+        raise ItemConflictError('Item {} was changed by another request'.format(item.product_id))
+
+def _remove_session(exception=None):
+    """ Ends the session of a request, with its replica and shard routing """
+    DB.session.remove()
+
 class Shopcart(DB.Model):
 
     logger = logging.getLogger('flask.app')
     app = None
+    cache = NullCache()
     # Table Schema
+    __table_args__ = (
+        DB.Index('ix_shopcart_customer_product', 'customer_id', 'product_id', unique=True),
+        DB.Index('ix_shopcart_customer_id', 'customer_id', 'id'),
+        # partial where the dialect supports it, a plain composite index elsewhere
+        DB.Index('ix_shopcart_customer_active', 'customer_id', 'state', 'id',
+                 postgresql_where=text('state = 0'), sqlite_where=text('state = 0')),
+        # picked by service.query.plan() for the filters and sorts of listings
+        DB.Index('ix_shopcart_customer_state_price', 'customer_id', 'state', 'price'),
+        DB.Index('ix_shopcart_customer_state_quantity', 'customer_id', 'state', 'quantity'),
+        DB.Index('ix_shopcart_customer_state_text', 'customer_id', 'state', 'text'),
+    )
     id = DB.Column(DB.Integer, primary_key=True)
     product_id = DB.Column(DB.Integer)
     customer_id = DB.Column(DB.Integer)
     quantity = DB.Column(DB.Integer)
     price = DB.Column(DB.Numeric(10, 2))
     text = DB.Column(DB.String(150))
-    state = DB.Column(DB.Integer)
+    state = DB.Column(DB.Integer, default=SHOPCART_ITEM_STAGE['ADDED'])
+    updated_at = DB.Column(DB.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = DB.Column(DB.Integer, nullable=False, default=1)
+    # ORM updates and deletes only match the row at the version they read
+    __mapper_args__ = {'version_id_col': version}
+
+    @classmethod
+    def in_state(cls, state):
+        """ Returns the condition matching the items in a state
+
+        The state is written into the statement instead of being bound, so
+        the planner can tell that the partial index of the ADDED items holds
+        every row the query needs.
+        """
+        return cls.state == literal_column(str(int(state)))
 
     @classmethod
     def find_by_cart_id(cls, cart_id):
@@ -57,20 +281,123 @@ class Shopcart(DB.Model):
         """
         cls.logger.info('Processing cart_id query for customer %s, product %s...',
                         customer_id, product_id)
+        route(DB, customer_id)
         return cls.query.filter(cls.customer_id == customer_id,
                                 cls.product_id == product_id).first()
 
     def __repr__(self):
         return '<Shopcart %r>' % (self.text)
 
-    def save(self):
+    def _stored_summary(self):
+        """ Returns what the item adds to the cart summary as it is in the database """
+        state = inspect(self)
+        if state.transient or state.pending:
+            return 0, Decimal(0)
+
+        def stored(name):
+            history = state.attrs[name].history
+            return history.deleted[0] if history.deleted else getattr(self, name)
+        return _summary(stored('state'), stored('quantity'), stored('price'))
+
+    def save(self, expected_version=None, item_version=None):
         """
         Saves a shopcart to the data store
+
+        Args:
+            expected_version (int): only save if the cart is still at this
+            version, raises StaleVersionError otherwise
+            item_version (int): only save if the item is still at this
+            version, raises ItemConflictError otherwise
         """
         Shopcart.logger.info('Saving %s', self.text)
+        route(DB, self.customer_id)
+        self._check_version(item_version)
+        count, subtotal = _summary(self.state, self.quantity, self.price)
+        stored_count, stored_subtotal = self._stored_summary()
         if not self.id:
             DB.session.add(self)
+        Cart.bump(self.customer_id, expected_version,
+                  count - stored_count, subtotal - stored_subtotal)
+        _commit_item(self)
+        Shopcart.invalidate(self.customer_id)
+
+    def _check_version(self, item_version):
+        """ Raises ItemConflictError unless the item was read at item_version """
+        if item_version is None or not self.id:
+            return
+        stored = inspect(self).attrs.version.history
+        version = stored.deleted[0] if stored.deleted else self.version
+        if version != item_version:
+            DB.session.rollback()
+            raise ItemConflictError('Item {} is no longer at version {}'
+                                    .format(self.product_id, item_version))
+
+    def create(self, merge_quantity=False):
+        """
+        Adds a new item to the cart in a single statement
+
+        The insert is skipped by the database when the product has a row
+        for the customer, so concurrent adds can never create a duplicate
+        row. A row that was removed or checked out is not in the cart and
+        is taken over by the new item, with its quantity, price and text.
+
+        Args:
+            merge_quantity (bool): add the quantity to the existing item
+            when the product is already in the cart
+        Returns:
+            True if the item was created, False if the product was already
+            in the cart. When merge_quantity is set this item holds the
+            merged row afterwards.
+        """
+        Shopcart.logger.info('Creating %s', self.text)
+        route(DB, self.customer_id)
+        table = Shopcart.__table__
+        if self.state is None:
+            self.state = SHOPCART_ITEM_STAGE['ADDED']
+        self.updated_at = datetime.utcnow()
+        values = {'customer_id': self.customer_id,
+                  'product_id': self.product_id,
+                  'quantity': self.quantity,
+                  'price': self.price,
+                  'text': self.text,
+                  'state': self.state,
+                  'updated_at': self.updated_at}
+        self.id = insert_if_absent(DB.session, table, values, ['customer_id', 'product_id'])
+        if self.id is None:
+            key = and_(table.c.customer_id == self.customer_id,
+                       table.c.product_id == self.product_id)
+            added = table.c.state == SHOPCART_ITEM_STAGE['ADDED']
+            before = DB.session.execute(select([table.c.state, table.c.quantity, table.c.price])
+                                        .where(key).with_for_update()).first()
+            if merge_quantity:
+                update = table.update().where(key).values(
+                    quantity=case([(added, table.c.quantity + self.quantity)], else_=self.quantity),
+                    price=case([(added, table.c.price)], else_=self.price),
+                    text=case([(added, table.c.text)], else_=self.text),
+                    state=SHOPCART_ITEM_STAGE['ADDED'])
+            else:
+                update = table.update().where(key).where(~added).values(
+                    quantity=self.quantity, price=self.price, text=self.text, state=self.state)
+            update = update.values(updated_at=self.updated_at, version=table.c.version + 1)
+            if before is None or not DB.session.execute(update).rowcount:
+                DB.session.rollback()
+                return False
+            row = DB.session.execute(select([table]).where(key)).first()
+            count, subtotal = _summary(row.state, row.quantity, row.price)
+            before_count, before_subtotal = _summary(*before)
+            Cart.bump(self.customer_id, None, count - before_count, subtotal - before_subtotal)
+            DB.session.commit()
+            Shopcart.invalidate(self.customer_id)
+            for column in table.columns:
+                setattr(self, column.name, row[column])
+            return before.state != SHOPCART_ITEM_STAGE['ADDED']
+        Cart.bump(self.customer_id, None, *_summary(self.state, self.quantity, self.price))
         DB.session.commit()
+        Shopcart.invalidate(self.customer_id)
+        # the row was written with Core, attach this item without reloading it
+        make_transient_to_detached(self)
+        DB.session.add(self)
+        return True
 
     def serialize(self):
         """
@@ -81,9 +408,10 @@ class Shopcart(DB.Model):
                 "product_id": self.product_id,
                 "customer_id": self.customer_id,
                 "quantity": self.quantity,
-                "price": str(self.price),
+                "price": price_text(self.price),
                 "text": self.text,
-                "state": self.state}
+                "state": self.state,
+                "version": self.version}
 
     def deserialize(self, data):
         """
@@ -103,29 +431,296 @@ class Shopcart(DB.Model):
         except TypeError as error:
             raise DataValidationError('Invalid shopcart item: body of request contained' \
                                       'bad or no data')
+        # the quantity and the price go into the summary of the cart
+        self.quantity = _positive_quantity(data)
+        self.price = _price(data)
         return self
 
+    @classmethod
+    def apply_batch(cls, customer_id, operations):
+        """ Applies a list of add, update and remove operations to a cart
+
+        The operations are resolved in order against one SELECT of the
+        products they touch, then written with bulk statements and a
+        single commit, so the whole batch succeeds or fails together.
+
+        Args:
+            customer_id (Integer): the id of the customer whose cart is changed
+            operations (list): dicts with an op ("add", "update" or "remove"),
+            a product_id and, for add and update, the item fields
+        Returns:
+            a list with one result dict (op, product_id, status, message)
+            per operation
+        Raises:
+            IntegrityError: if another request added one of the products
+            while the batch was applied
+            StaleVersionError: if another request removed one of the items
+            the batch updates
+        """
+        cls.logger.info('Processing batch of %s operations for customer %s',
+                        len(operations), customer_id)
+        route(DB, customer_id)
+        product_ids = set()
+        for operation in operations:
+            try:
+                product_ids.add(_product_id(operation))
+            except DataValidationError:
+                pass
+        existing = {item.product_id: item for item in
+                    cls.query.filter(cls.customer_id == customer_id,
+                                     cls.product_id.in_(product_ids))}
+        inserts = {}
+        updates = {}
+        deletes = []
+        removed = []
+        results = []
+        for operation in operations:
+            result = {'op': None, 'product_id': None}
+            results.append(result)
+            try:
+                if isinstance(operation, dict):
+                    result['op'] = operation.get('op')
+                result['product_id'] = product_id = _product_id(operation)
+                if result['op'] == 'add':
+                    if product_id in inserts or product_id in updates or \
+                            product_id in existing and existing[product_id].state in \
+                            (None, SHOPCART_ITEM_STAGE['ADDED']):
+                        result.update(status=409, message='Item already in the cart')
+                        continue
+                    item = cls().deserialize(dict(operation, customer_id=customer_id))
+                    if product_id in existing:
+                        # a removed or checked out item is taken over, as create() does
+                        updates[product_id] = {'id': existing[product_id].id,
+                                               'quantity': item.quantity,
+                                               'price': item.price,
+                                               'text': item.text,
+                                               'state': SHOPCART_ITEM_STAGE['ADDED'],
+                                               'version': existing[product_id].version}
+                    else:
+                        inserts[product_id] = {'customer_id': customer_id,
+                                               'product_id': product_id,
+                                               'quantity': item.quantity,
+                                               'price': item.price,
+                                               'text': item.text,
+                                               'state': SHOPCART_ITEM_STAGE['ADDED']}
+                    result.update(status=201, message='Item added')
+                elif result['op'] == 'update':
+                    quantity = _positive_quantity(operation)
+                    if product_id in inserts:
+                        inserts[product_id]['quantity'] = quantity
+                    elif product_id in existing:
+                        version = existing[product_id].version
+                        if operation.get('version') not in (None, version):
+                            result.update(status=409, message='Item is no longer at version {}'
+                                          .format(operation['version']))
+                            continue
+                        # the update only matches the item at the version read here
+                        updates.setdefault(product_id, {'id': existing[product_id].id,
+                                                        'version': version})
+                        updates[product_id].update(quantity=quantity,
+                                                   state=SHOPCART_ITEM_STAGE['ADDED'])
+                    else:
+                        result.update(status=404, message='Product not in cart')
+                        continue
+                    result.update(status=200, message='Item updated')
+                elif result['op'] == 'remove':
+                    if product_id in inserts:
+                        del inserts[product_id]
+                    elif product_id in existing:
+                        removed.append(existing.pop(product_id))
+                        deletes.append(removed[-1].id)
+                        updates.pop(product_id, None)
+                    result.update(status=204, message='Item removed')
+                else:
+                    raise DataValidationError('Invalid operation: op must be add, update or remove')
+            except DataValidationError as error:
+                result.update(status=400, message=str(error))
+
+        # deletes go first so a product can be removed and added again
+        if deletes:
+            cls.query.filter(cls.id.in_(deletes)).delete(synchronize_session=False)
+        if updates:
+            try:
+                DB.session.bulk_update_mappings(cls, list(updates.values()))
+            except StaleDataError:
+                DB.session.rollback()
+                raise StaleVersionError('Items of customer {} were removed during the batch'
+                                        .format(customer_id))
+        if inserts:
+            DB.session.bulk_insert_mappings(cls, list(inserts.values()))
+        if deletes or updates or inserts:
+            changes = [(1, _summary(SHOPCART_ITEM_STAGE['ADDED'], item['quantity'], item['price']))
+                       for item in inserts.values()]
+            for product_id, update in updates.items():
+                item = existing[product_id]
+                changes.append((1, _summary(update['state'], update['quantity'],
+                                            update.get('price', item.price))))
+                changes.append((-1, _summary(item.state, item.quantity, item.price)))
+            changes += [(-1, _summary(item.state, item.quantity, item.price)) for item in removed]
+            Cart.bump(customer_id, None,
+                      sum(sign * count for sign, (count, _) in changes),
+                      sum(sign * subtotal for sign, (_, subtotal) in changes))
+        try:
+            DB.session.commit()
+        except IntegrityError:
+            DB.session.rollback()
+            raise
+        cls.invalidate(customer_id)
+        return results
+
+    @classmethod
+    def increment(cls, customer_id, product_id, delta, expected_version=None, item_version=None):
+        """ Adds delta to the quantity of an ADDED item in a single statement
+
+        The database adds to the quantity it holds, so concurrent increments
+        all count without reading the item first or locking it across
+        requests.
+
+        Args:
+            delta (int): the quantity to add, negative to take some away
+            expected_version (int): only change the item if the cart is still
+            at this version, raises StaleVersionError otherwise
+            item_version (int): only change the item if it is still at this
+            version
+        Returns:
+            the item as it is after the change, None if the product is not
+            in the cart
+        Raises:
+            ItemConflictError: if the item is not at item_version or its
+            quantity would drop below 1
+        """
+        cls.logger.info('Adding %s to product %s for customer %s', delta, product_id, customer_id)
+        route(DB, customer_id)
+        table = cls.__table__
+        key = and_(table.c.customer_id == customer_id, table.c.product_id == product_id,
+                   table.c.state == SHOPCART_ITEM_STAGE['ADDED'])
+        update = table.update().where(key).where(table.c.quantity + delta >= 1) \
+            .values(quantity=table.c.quantity + delta, version=table.c.version + 1,
+                    updated_at=datetime.utcnow())
+        if item_version is not None:
+            update = update.where(table.c.version == item_version)
+        if not DB.session.execute(update).rowcount:
+            row = DB.session.execute(select([table.c.quantity, table.c.version])
+                                     .where(key)).first()
+            DB.session.rollback()
+            if row is None:
+                return None
+            if item_version is not None and row.version != item_version:
+                raise ItemConflictError('Item {} is no longer at version {}'
+                                        .format(product_id, item_version))
+            raise ItemConflictError('Quantity of item {} cannot drop from {} to {}'
+                                    .format(product_id, row.quantity, row.quantity + delta))
+        row = DB.session.execute(select([table]).where(key)).first()
+        count, subtotal = _summary(row.state, row.quantity, row.price)
+        before_count, before_subtotal = _summary(row.state, row.quantity - delta, row.price)
+        Cart.bump(customer_id, expected_version, count - before_count, subtotal - before_subtotal)
+        DB.session.commit()
+        cls.invalidate(customer_id)
+        return cls(**{column.name: row[column] for column in table.columns})
+
+    @classmethod
+    def checkout_cart(cls, customer_id):
+        """ Moves every ADDED item of a cart to DONE in one transaction
+
+        The items are locked while they are read so two checkouts of the
+        same cart cannot both pick them up.
+
+        Args:
+            customer_id (Integer): the id of the customer checking out
+        Returns:
+            a list with the serialized items that were checked out
+        """
+        cls.logger.info('Processing checkout of the cart of customer %s', customer_id)
+        route(DB, customer_id)
+        items = cls.query.filter(cls.customer_id == customer_id,
+                                 cls.state == SHOPCART_ITEM_STAGE['ADDED']) \
+            .order_by(cls.id).with_for_update().all()
+        if not items:
+            DB.session.rollback()
+            return []
+        results = []
+        for item in items:
+            result = item.serialize()
+            result['state'] = SHOPCART_ITEM_STAGE['DONE']
+            result['version'] = item.version + 1
+            results.append(result)
+        cls.query.filter(cls.id.in_([item.id for item in items])) \
+            .update({cls.state: SHOPCART_ITEM_STAGE['DONE'], cls.version: cls.version + 1},
+                    synchronize_session=False)
+        OrderOutbox.add(customer_id, {'customer_id': customer_id,
+                                      'items': [item.order_line() for item in items]})
+        summaries = [_summary(item.state, item.quantity, item.price) for item in items]
+        Cart.bump(customer_id, None, -sum(count for count, _ in summaries),
+                  -sum(subtotal for _, subtotal in summaries))
+        DB.session.commit()
+        cls.invalidate(customer_id)
+        return results
+
+    def checkout(self):
+        """
+        Moves the item to DONE and queues its order in the same transaction
+        """
+        Shopcart.logger.info('Checking out %s', self.id)
+        route(DB, self.customer_id)
+        count, subtotal = self._stored_summary()
+        self.state = SHOPCART_ITEM_STAGE['DONE']
+        order = self.order_line()
+        order['customer_id'] = self.customer_id
+        OrderOutbox.add(self.customer_id, order)
+        Cart.bump(self.customer_id, None, -count, -subtotal)
+        _commit_item(self)
+        Shopcart.invalidate(self.customer_id)
+
+    def order_line(self):
+        """ Returns the item as a line of an order for the order service """
+        return {'product_id': self.product_id,
+                'price': float(self.price) if self.price is not None else None,
+                'quantity': self.quantity}
+
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """ Initializes the database session
+
+        Only the engines are set up, service.migrations creates the tables.
+        """
         cls.logger.info('Initializing database')
         cls.app = app
+        cls.cache = create_cache(app.config)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+        DB.replicas.dispose()
+        DB.replicas = ReplicaSet.from_config(
+            app.config, lambda uri: engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=uri)))
+        DB.shards.dispose()
+        DB.shards = ShardSet.from_config(
+            app.config, lambda uri: engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=uri)))
         # This is where we initialize SQLAlchemy from the Flask app
         DB.init_app(app)
+        # the app context pushed here lasts as long as the process, so the
+        # teardown_appcontext of Flask-SQLAlchemy never runs for a request
+        if _remove_session not in app.teardown_request_funcs.get(None, []):
+            app.teardown_request(_remove_session)
         app.app_context().push()
-        DB.create_all()  # make our sqlalchemy tables
 
     @classmethod
     def all(cls):
-        """ Returns all of the Shopcarts in the database """
+        """ Returns all of the Shopcarts in the database, of every shard """
         cls.logger.info('Get all shopcarts')
-        return cls.query.all()
+        items = []
+        for _ in each_shard(DB):
+            items.extend(cls.query.all())
+        return items
 
-    def delete(self):
-        ## Remove an item from the data store
+    def delete(self, expected_version=None, item_version=None):
+        ## Remove an item from the data store, only if the cart is still at
+        ## expected_version and the item at item_version when they are given
         Shopcart.logger.info('Deleting %s', self.id)
+        route(DB, self.customer_id)
+        self._check_version(item_version)
+        count, subtotal = self._stored_summary()
         DB.session.delete(self)
-        DB.session.commit()
+        Cart.bump(self.customer_id, expected_version, -count, -subtotal)
+        _commit_item(self)
+        Shopcart.invalidate(self.customer_id)
 
     @classmethod
     def find_by_product_id(cls, product_id):
@@ -134,13 +729,130 @@ class Shopcart(DB.Model):
         return cls.query.filter(cls.product_id == product_id)
 
     @classmethod
-    def find_by_customer_id(cls, customer_id):
+    def find_by_customer_id(cls, customer_id, state=SHOPCART_ITEM_STAGE['ADDED']):
         """ Returns all items with the given customer_id
         Args:
             customer_id (Integer): the id of the customer of the shopcart you want to match
+            state (int): only return items in this state, every item when None
         """
         cls.logger.info('Processing customer_id query for %s ...', customer_id)
-        return cls.query.filter(cls.customer_id == customer_id)
+        route(DB, customer_id)
+        query = cls.query.filter(cls.customer_id == customer_id)
+        if state is not None:
+            query = query.filter(cls.in_state(state))
+        return query.order_by(cls.id)
+
+    @classmethod
+    def page_query(cls, customer_id, limit=None, after=None, fields=None, price=None,
+                   state=SHOPCART_ITEM_STAGE['ADDED'], item_query=None):
+        """ Returns the query of find_page() and the name of the index planned for it
+
+        One row more than `limit` is selected to tell whether a page follows.
+        """
+        route(DB, customer_id)
+        item_query = item_query or ItemQuery()
+        if price is not None:
+            item_query = item_query._replace(max_price=price if item_query.max_price is None
+                                             else min(price, item_query.max_price))
+        fields = fields or SHOPCART_FIELDS
+        columns = [getattr(cls, name) for name in fields]
+        if 'id' not in fields:
+            columns.append(cls.id)
+        index = plan(item_query, state)
+        query = DB.session.query(*columns).filter(cls.customer_id == customer_id) \
+            .with_hint(cls, 'USE INDEX ({})'.format(index), 'mysql')
+        if state is not None:
+            query = query.filter(cls.in_state(state))
+        for condition in item_query.conditions(cls):
+            query = query.filter(condition)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        query = query.order_by(*item_query.order_by(cls))
+        if limit is not None:
+            query = query.limit(limit + 1)
+        return query, index
+
+    @classmethod
+    def find_page(cls, customer_id, limit=None, after=None, fields=None, price=None,
+                  state=SHOPCART_ITEM_STAGE['ADDED'], item_query=None):
+        """ Returns a page of serialized items and the cursor of the next page
+
+        Items are ordered by id and the page starts right after the item
+        with id `after`, so any page is read through the customer index
+        however large the cart is. Only the columns of `fields` are selected
+        and the rows are turned into dicts without loading Shopcart objects.
+        The cursor is None on the last page, and on the only page of a query
+        sorted by other fields than id.
+        Args:
+            customer_id (Integer): the id of the customer of the shopcart you want to list
+            limit (int): the most items in the page, every item when None
+            after (int): the id of the last item of the previous page
+            fields (list): the names of the fields to return, all of them when None
+            price (Numeric): only return items with this price or below
+            state (int): only return items in this state, every item when None
+            item_query (ItemQuery): the ranges, text prefix and sort keys of the items
+        """
+        fields = fields or SHOPCART_FIELDS
+        query, _ = cls.page_query(customer_id, limit, after, fields, price, state, item_query)
+        rows = query.all()
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            # the ids of a query in another order are no cursor
+            if item_query is None or not item_query.sorted:
+                cursor = rows[-1].id
+        # the id column added for the cursor is past the end of fields
+        items = [dict(zip(fields, row)) for row in rows]
+        if 'price' in fields:
+            for item in items:
+                item['price'] = price_text(item['price'])
+        return items, cursor
+
+    @classmethod
+    def find_page_on_replica(cls, customer_id, version, limit=None, after=None, fields=None,
+                             price=None, state=SHOPCART_ITEM_STAGE['ADDED'], item_query=None):
+        """ Returns find_page() read from a replica that has the cart at version
+
+        The page is read from the primary when no replica has caught up.
+        Args:
+            version (int): the version of the cart on the primary
+        """
+        return replica_read(DB, lambda: cls.find_page(customer_id, limit, after, fields, price,
+                                                      state, item_query),
+                            fresh=lambda: Cart.version_of(customer_id) >= version)
+
+    @classmethod
+    def serialize_cart(cls, customer_id, version=None, limit=None):
+        """ Returns the version, the first page of serialized ADDED items and the next cursor
+
+        The version is read first and the page is served from the cart
+        cache only when it was cached at that version with the same limit,
+        so a cache entry that another worker did not invalidate is never used.
+        Args:
+            customer_id (Integer): the id of the customer of the shopcart you want to list
+            version (int): the version of the cart if the caller already read it
+            limit (int): the most items in the page, every item when None
+        """
+        if version is None:
+            version = Cart.version_of(customer_id)
+        key = cls.cache_key(customer_id)
+        cached = cls.cache.get(key)
+        if cached is not None and cached['version'] == version and cached['limit'] == limit:
+            return version, cached['items'], cached['cursor']
+        items, cursor = cls.find_page_on_replica(customer_id, version, limit)
+        cls.cache.set(key, {'version': version, 'limit': limit,
+                            'items': items, 'cursor': cursor})
+        return version, items, cursor
+
+    @staticmethod
+    def cache_key(customer_id):
+        """ Returns the cart cache key of a customer """
+        return 'cart:{}'.format(customer_id)
+
+    @classmethod
+    def invalidate(cls, customer_id):
+        """ Removes a customer's cart from the cart cache after a write """
+        cls.cache.delete(cls.cache_key(customer_id))
 
     @classmethod
     def find_by_customer_id_and_product_id(cls, customer_id, product_id):
@@ -150,11 +862,23 @@ class Shopcart(DB.Model):
         """
         cls.logger.info('Processing customer_id & product_id query for customer %s, product %s...',
                         customer_id, product_id)
+        route(DB, customer_id)
         return cls.query.filter((cls.customer_id == customer_id)
                                 & (cls.product_id == product_id)).first()
 
     @classmethod
-    def query_by_target_price(cls, customer_id, price):
+    def find_item_on_replica(cls, customer_id, product_id, version):
+        """ Returns find_by_customer_id_and_product_id() read from a replica
+
+        The item is read from the primary when no replica has the cart at
+        version yet.
+        """
+        return replica_read(DB, lambda: cls.find_by_customer_id_and_product_id(customer_id,
+                                                                                product_id),
+                            fresh=lambda: Cart.version_of(customer_id) >= version)
+
+    @classmethod
+    def query_by_target_price(cls, customer_id, price, state=SHOPCART_ITEM_STAGE['ADDED']):
         """ Returns all items with the given customer_id and below the price
         Args:
             customer_id (Integer):
@@ -162,13 +886,251 @@ class Shopcart(DB.Model):
             price(Numeric):
             the price of the items that are set as target,
             so all selected items are below that target
+            state (int): only return items in this state, every item when None
         """
         cls.logger.info('Processing customer query for %s and price query for %s...',
                         customer_id, price)
-        return cls.query.filter((cls.customer_id == customer_id) & (cls.price <= price))
+        route(DB, customer_id)
+        query = cls.query.filter((cls.customer_id == customer_id) & (cls.price <= price))
+        if state is not None:
+            query = query.filter(cls.in_state(state))
+        return query.order_by(cls.id)
     
     @classmethod
     def remove_all(cls):
         """ Removes all documents from the database (use for testing)  """
-        DB.session.query(Shopcart).delete()
+        for _ in each_shard(DB):
+            DB.session.query(Shopcart).delete()
+            # bump instead of deleting so versions handed out before stay stale
+            Cart.query.update({Cart.version: Cart.version + 1, Cart.item_count: 0,
+                               Cart.subtotal: 0}, synchronize_session=False)
+            DB.session.commit()
+        cls.cache.clear()
+
+
+class Cart(DB.Model):
+    """ The version of a customer's cart
+
+    Every write to the items of a cart bumps the version in the same
+    transaction, so the version identifies the state of the cart. It backs
+    the ETags of the cart resources and the optimistic concurrency checks.
+    The item count and the subtotal are changed by the same statement, so
+    the cart summary is a single row read. service.summary repairs drift.
+    """
+    logger = logging.getLogger('flask.app')
+    # Table Schema
+    customer_id = DB.Column(DB.Integer, primary_key=True, autoincrement=False)
+    version = DB.Column(DB.Integer, nullable=False, default=0)
+    item_count = DB.Column(DB.Integer, nullable=False, default=0)
+    subtotal = DB.Column(DB.Numeric(12, 2), nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Cart %r v%r>' % (self.customer_id, self.version)
+
+    @classmethod
+    def summary_of(cls, customer_id):
+        """ Returns the version, item count and subtotal of a customer's cart """
+        route(DB, customer_id)
+        row = DB.session.query(cls.version, cls.item_count, cls.subtotal) \
+            .filter(cls.customer_id == customer_id).first()
+        if row is None:
+            return 0, 0, Decimal('0.00')
+        return row.version, row.item_count or 0, \
+            Decimal(row.subtotal or 0).quantize(Decimal('0.01'))
+
+    @classmethod
+    def version_of(cls, customer_id):
+        """ Returns the version of a customer's cart, 0 if it was never written """
+        route(DB, customer_id)
+        version = DB.session.query(cls.version) \
+            .filter(cls.customer_id == customer_id).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls, customer_id, expected_version=None, items=0, subtotal=0):
+        """ Bumps the version of a cart in the current transaction
+
+        Args:
+            customer_id (Integer): the customer whose cart is written
+            expected_version (int): only bump if the cart is at this version
+            items (int): change of the item count
+            subtotal (Decimal): change of the subtotal
+        Raises:
+            StaleVersionError: if the cart is not at expected_version, the
+            transaction is rolled back
+            CartMovingError: if the cart is being moved to another shard, the
+            transaction is rolled back
+        """
+        if customer_id is None:
+            return
+        route(DB, customer_id)
+        if DB.session.info.get('moving'):
+            DB.session.rollback()
+            raise CartMovingError('Cart of customer {} is moving to another shard'
+                                  .format(customer_id))
+        table = cls.__table__
+        update = table.update().where(table.c.customer_id == customer_id) \
+            .values(version=table.c.version + 1, item_count=table.c.item_count + items,
+                    subtotal=table.c.subtotal + subtotal)
+        if expected_version is not None:
+            update = update.where(table.c.version == expected_version)
+        if DB.session.execute(update).rowcount:
+            return
+        if expected_version in (None, 0) and insert_if_absent(
+                DB.session, table, {'customer_id': customer_id, 'version': 1,
+                                    'item_count': items, 'subtotal': subtotal},
+                ['customer_id']) is not None:
+            return
+        if expected_version is None:
+            # another transaction created the row first
+            DB.session.execute(update)
+            return
+        DB.session.rollback()
+        raise StaleVersionError('Cart of customer {} is no longer at version {}'
+                                .format(customer_id, expected_version))
+
+
+class OrderOutbox(DB.Model):
+    """ An order waiting to be delivered to the order service
+
+    Checkout writes the order here in the same transaction that moves the
+    cart items to DONE, so an order is never lost and never sent for items
+    that were not checked out. service.dispatcher delivers the orders.
+    """
+    logger = logging.getLogger('flask.app')
+    # Table Schema
+    __tablename__ = 'order_outbox'
+    __table_args__ = (
+        DB.Index('ix_order_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+    id = DB.Column(DB.Integer, primary_key=True)
+    idempotency_key = DB.Column(DB.String(36), nullable=False, unique=True)
+    customer_id = DB.Column(DB.Integer)
+    payload = DB.Column(DB.Text, nullable=False)
+    status = DB.Column(DB.Integer, nullable=False, default=OUTBOX_STATUS['PENDING'])
+    attempts = DB.Column(DB.Integer, nullable=False, default=0)
+    next_attempt_at = DB.Column(DB.DateTime, nullable=False, default=datetime.utcnow)
+    claim_token = DB.Column(DB.String(36))
+    last_error = DB.Column(DB.String(255))
+    created_at = DB.Column(DB.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<OrderOutbox %r>' % (self.idempotency_key)
+
+    @classmethod
+    def add(cls, customer_id, order):
+        """ Adds an order to the current transaction, the caller commits it
+
+        Args:
+            customer_id (Integer): the customer that checked out
+            order (dict): the order to send to the order service
+        """
+        cls.logger.info('Queueing order for customer %s', customer_id)
+        entry = cls(idempotency_key=str(uuid.uuid4()),
+                    customer_id=customer_id,
+                    payload=json.dumps(order))
+        DB.session.add(entry)
+        return entry
+
+    @property
+    def order(self):
+        """ Returns the order as a dictionary """
+        return json.loads(self.payload)
+
+    @classmethod
+    def claim(cls, batch_size, lease_seconds, now=None):
+        """ Claims a batch of pending orders that are due for delivery
+
+        The claim pushes next_attempt_at past the lease in one conditional
+        UPDATE, so concurrent dispatchers never claim the same order and an
+        order claimed by a dispatcher that died is retried once the lease
+        runs out.
+
+        Args:
+            batch_size (int): the most orders to claim
+            lease_seconds (float): how long the orders are reserved
+        Returns:
+            the claimed orders, oldest first
+        """
+        now = now or datetime.utcnow()
+        due = [row.id for row in DB.session.query(cls.id)
+               .filter(cls.status == OUTBOX_STATUS['PENDING'], cls.next_attempt_at <= now)
+               .order_by(cls.id).limit(batch_size)]
+        if not due:
+            DB.session.rollback()
+            return []
+        token = str(uuid.uuid4())
+        cls.query.filter(cls.id.in_(due),
+                         cls.status == OUTBOX_STATUS['PENDING'],
+                         cls.next_attempt_at <= now) \
+            .update({cls.claim_token: token,
+                     cls.next_attempt_at: now + timedelta(seconds=lease_seconds)},
+                    synchronize_session=False)
+        DB.session.commit()
+        return cls.query.filter(cls.claim_token == token).order_by(cls.id).all()
+
+    @classmethod
+    def mark_sent(cls, entries):
+        """ Marks delivered orders as SENT and commits the batch """
+        if entries:
+            cls.query.filter(cls.id.in_([entry.id for entry in entries])) \
+                .update({cls.status: OUTBOX_STATUS['SENT'], cls.claim_token: None},
+                        synchronize_session=False)
         DB.session.commit()
+
+    def mark_failed(self, error, retry_at=None):
+        """ Records a failed delivery
+
+        Args:
+            error (str): why the delivery failed
+            retry_at (datetime): when to try again, or None to give up
+        """
+        self.attempts += 1
+        self.last_error = str(error)[:255]
+        self.claim_token = None
+        if retry_at is None:
+            self.logger.error('Giving up on order %s after %s attempts: %s',
+                              self.idempotency_key, self.attempts, error)
+            self.status = OUTBOX_STATUS['FAILED']
+        else:
+            self.next_attempt_at = retry_at
+
+    @classmethod
+    def find_by_status(cls, status):
+        """ Returns all of the orders with the given status """
+        return cls.query.filter(cls.status == status).order_by(cls.id)
+
+
+class ShopcartHistory(DB.Model):
+    """ An item moved out of the live shopcart table
+
+    service.compaction moves items that were removed or checked out a while
+    ago and items left in a cart for too long here, so the shopcart table
+    only holds the carts that are in use.
+    """
+    logger = logging.getLogger('flask.app')
+    # Table Schema
+    __tablename__ = 'shopcart_history'
+    __table_args__ = (
+        DB.Index('ix_shopcart_history_customer', 'customer_id', 'archived_at'),
+    )
+    id = DB.Column(DB.Integer, primary_key=True)
+    item_id = DB.Column(DB.Integer, nullable=False)
+    product_id = DB.Column(DB.Integer)
+    customer_id = DB.Column(DB.Integer)
+    quantity = DB.Column(DB.Integer)
+    price = DB.Column(DB.Numeric(10, 2))
+    text = DB.Column(DB.String(150))
+    state = DB.Column(DB.Integer)
+    updated_at = DB.Column(DB.DateTime)
+    archived_at = DB.Column(DB.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<ShopcartHistory %r of customer %r>' % (self.item_id, self.customer_id)
+
+    @classmethod
+    def find_by_customer_id(cls, customer_id):
+        """ Returns the archived items of a customer, the latest first """
+        route(DB, customer_id)
+        return cls.query.filter(cls.customer_id == customer_id) \
+            .order_by(cls.archived_at.desc(), cls.id.desc())
@@ -0,0 +1,190 @@
+"""
+Order Service Client
+
+Sends orders from the shopcart to the order service over a pooled
+keep-alive HTTP session.
+
+Every call is bounded by a connect and a read timeout, failed connections
+and 503 answers are retried a few times with exponential backoff,
+and a circuit breaker stops calling the order service for a while after it
+failed several times in a row, so a slow or dead order service can never
+hold a worker for long.
+"""
+import os
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger('flask.app')
+
+
+class OrderServiceError(Exception):
+    """ Used when an order could not be delivered to the order service """
+    pass
+
+
+class CircuitOpenError(OrderServiceError):
+    """ Used when the circuit breaker is open and the call was not attempted """
+    pass
+
+
+class CircuitBreaker(object):
+    """ Counts consecutive failures and opens after too many of them
+
+    While the breaker is open every call is rejected. Once reset_timeout
+    seconds have passed one trial call is let through (half open): if it
+    succeeds the breaker closes again, if it fails it opens for another
+    reset_timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """ Returns the current state of the breaker """
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        """ Returns True if a call may be attempted now """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        """ Closes the breaker after a successful call """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        """ Counts a failed call and opens the breaker when needed """
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('Order service circuit breaker opened after %s failures',
+                                   self.failures)
+                self.opened_at = self.clock()
+            self._trial_running = False
+
+
+class OrderClient(object):
+    """ Client for the order service
+
+    The HTTP session is created lazily and again after a fork, so every
+    gunicorn worker gets its own connection pool even when the app is
+    preloaded in the master process.
+    """
+
+    def __init__(self, base_url, connect_timeout=1.0, read_timeout=5.0, retries=2,
+                 backoff_factor=0.1, pool_maxsize=10, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_maxsize = pool_maxsize
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Creates a client from the ORDER_* settings of a Flask config """
+        return cls(config['ORDER_HOST_URL'],
+                   connect_timeout=config['ORDER_CONNECT_TIMEOUT'],
+                   read_timeout=config['ORDER_READ_TIMEOUT'],
+                   retries=config['ORDER_RETRIES'],
+                   backoff_factor=config['ORDER_RETRY_BACKOFF'],
+                   pool_maxsize=config['ORDER_POOL_MAXSIZE'],
+                   breaker=CircuitBreaker(config['ORDER_BREAKER_THRESHOLD'],
+                                          config['ORDER_BREAKER_RESET']))
+
+    @property
+    def session(self):
+        """ Returns the HTTP session of the current process """
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                self._session = self._create_session()
+                self._pid = os.getpid()
+            return self._session
+
+    def _create_session(self):
+        """ Creates a keep-alive session that retries failed connections """
+        # POST is only retried when the request never reached the server or
+        # the order service answered 503, turning the order away before it
+        # took it. A read timeout, a 502 or a 504 may come after the order
+        # was created, so the order is not sent again after them
+        retry = Retry(total=self.retries, connect=self.retries, read=0,
+                      status=self.retries, status_forcelist=(503,),
+                      method_whitelist=frozenset(['GET', 'POST']),
+                      backoff_factor=self.backoff_factor, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def create_order(self, order, headers=None):
+        """ Posts an order to the order service
+
+        Args:
+            order (dict): the order to create
+            headers (dict): extra HTTP headers to send with the order
+        Returns:
+            the JSON body of the order service response, or None if it had none
+        Raises:
+            CircuitOpenError: if the circuit breaker is open
+            OrderServiceError: if the order service could not create the order
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError('Order service is unavailable, circuit breaker is open')
+        url = '{}/orders'.format(self.base_url)
+        try:
+            response = self.session.post(url, json=order, headers=headers, timeout=self.timeout)
+        except requests.RequestException as error:
+            self.breaker.record_failure()
+            raise OrderServiceError('Order service request failed: {}'.format(error))
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise OrderServiceError('Order service returned {}'.format(response.status_code))
+        # a 4xx answer means the order service is up, so the breaker is reset
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            raise OrderServiceError('Order service rejected the order with {}: {}'
+                                    .format(response.status_code, response.text))
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+    def close(self):
+        """ Closes the pooled connections """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
@@ -0,0 +1,144 @@
+"""
+Database Connection Pool
+
+Builds the SQLAlchemy engine options from the DB_POOL_* settings and times
+how long requests wait to check a connection out of the pool, which is
+where pool exhaustion shows up first. GET /health reports the pool
+utilization, the checkout waits and the round trip time to the database.
+
+Every gunicorn worker has its own pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+"""
+import time
+import threading
+from sqlalchemy import exc, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from prometheus_client import Counter, Histogram
+
+CHECKOUT_WAIT = Histogram('shopcart_db_pool_checkout_wait_seconds',
+                          'Time spent waiting for a pooled connection',
+                          buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+CHECKOUT_TIMEOUTS = Counter('shopcart_db_pool_checkout_timeouts_total',
+                            'Checkouts that gave up after DB_POOL_TIMEOUT')
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that records how long every checkout waits """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            CHECKOUT_TIMEOUTS.inc()
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            CHECKOUT_WAIT.observe(wait)
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+
+
+def engine_options(config):
+    """ Returns the SQLALCHEMY_ENGINE_OPTIONS for the DB_POOL_* settings of a config
+
+    SQLite does not pool connections, only recycling and pre ping apply to it.
+    """
+    options = {'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+               'pool_recycle': config.get('DB_POOL_RECYCLE', 1800)}
+    if make_url(config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'sqlite':
+        options.update(poolclass=TimedQueuePool,
+                       pool_size=config.get('DB_POOL_SIZE', 5),
+                       max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+                       pool_timeout=config.get('DB_POOL_TIMEOUT', 30))
+    return options
+
+
+def pool_status(engine):
+    """ Returns the size, use and checkout waits of an engine's pool """
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update(size=pool.size(),
+                      max_overflow=pool._max_overflow,
+                      checked_out=pool.checkedout(),
+                      checked_in=pool.checkedin(),
+                      overflow=max(pool.overflow(), 0),
+                      utilization=round(float(pool.checkedout()) / capacity, 4) if capacity else 0.0)
+    if isinstance(pool, TimedQueuePool):
+        with pool._stats_lock:
+            status.update(checkouts=pool.checkouts,
+                          timeouts=pool.timeouts,
+                          wait_mean_ms=round(1000 * pool.wait_total / pool.checkouts, 3)
+                          if pool.checkouts else 0.0,
+                          wait_max_ms=round(1000 * pool.wait_max, 3))
+    return status
+
+
+def database_latency(engine):
+    """ Returns the seconds a SELECT 1 round trip takes, checkout included """
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1' if engine.dialect.name not in ('db2', 'ibm_db_sa')
+                                else 'SELECT 1 FROM SYSIBM.SYSDUMMY1'))
+    return time.perf_counter() - start
+
+
+def replica_health(replicas):
+    """ Returns the round trip time of every replica, marking the failing ones down """
+    healthy = replicas.healthy()
+    report = []
+    for engine in replicas.engines:
+        entry = {'url': repr(engine.url), 'healthy': engine in healthy}
+        try:
+            entry['latency_ms'] = round(1000 * database_latency(engine), 3)
+        except exc.SQLAlchemyError as error:
+            replicas.mark_down(engine)
+            entry.update(healthy=False, error=str(error).splitlines()[0])
+        report.append(entry)
+    return report
+
+
+def shard_health(shards):
+    """ Returns the round trip time and pool use of every shard """
+    report = []
+    for name, engine in zip(shards.names, shards.engines):
+        entry = {'name': name, 'url': repr(engine.url), 'pool': pool_status(engine)}
+        try:
+            entry['latency_ms'] = round(1000 * database_latency(engine), 3)
+        except exc.SQLAlchemyError as error:
+            entry['error'] = str(error).splitlines()[0]
+        report.append(entry)
+    return report
+
+
+def health(engine, saturation=0.9):
+    """ Returns the health of the database and its pool
+
+    The status is ok, degraded when the pool utilization reaches saturation
+    or failing when the database cannot be reached.
+    """
+    report = {'status': 'ok', 'pool': pool_status(engine)}
+    try:
+        report['database'] = {'latency_ms': round(1000 * database_latency(engine), 3)}
+    except exc.SQLAlchemyError as error:
+        report['status'] = 'failing'
+        report['database'] = {'error': str(error).splitlines()[0]}
+        return report
+    if report['pool'].get('utilization', 0) >= saturation:
+        report['status'] = 'degraded'
+    return report
@@ -0,0 +1,165 @@
+"""
+Cart Item Queries
+
+The filters and the sort order of a cart listing, and the planner that
+picks the index serving them. A listing is scoped to one customer and, unless
+it asks for every state, to one state, so the indexes of the shopcart table
+start with (customer_id, state) and end with the column a query narrows or
+orders by:
+
+    ix_shopcart_customer_active - id, the listing without filters
+    ix_shopcart_customer_state_price - price ranges and sorts by price
+    ix_shopcart_customer_state_quantity - quantity ranges and sorts by quantity
+    ix_shopcart_customer_state_text - text prefixes and sorts by text
+
+The planner takes the index of a range that also gives the order of the
+first sort key, then the index of any range, then the index of the first
+sort key. MySQL is told to use that index, the other databases pick from the
+same indexes on their own.
+
+A text prefix is matched with LIKE, so it follows the collation of the
+column: SQLite and MySQL ignore the case of ASCII letters, PostgreSQL does
+not. MySQL reads the prefix as a range of the text index, the other
+databases read the items of the customer and state from it.
+"""
+from decimal import Decimal, InvalidOperation
+from collections import namedtuple
+
+SORT_KEYS = ('id', 'product_id', 'quantity', 'price', 'text')
+MAX_SORT_KEYS = 3
+# the column a query narrows or orders by -> the index that ends with it
+RANGE_INDEXES = {'text': 'ix_shopcart_customer_state_text',
+                 'price': 'ix_shopcart_customer_state_price',
+                 'quantity': 'ix_shopcart_customer_state_quantity'}
+ACTIVE_INDEX = 'ix_shopcart_customer_active'
+CUSTOMER_INDEX = 'ix_shopcart_customer_id'
+ADDED = 0
+LIKE_ESCAPE = '\\'
+
+
+class ItemQuery(namedtuple('ItemQuery', ('min_price', 'max_price', 'min_quantity',
+                                         'max_quantity', 'text', 'sort'))):
+    """ The filters and sort keys of a cart listing
+
+    Attributes:
+        min_price, max_price (Decimal): the price range, open ended when None
+        min_quantity, max_quantity (int): the quantity range, open ended when None
+        text (str): the prefix of the item texts, every text when empty
+        sort (tuple): (field, descending) pairs, by id when empty
+    """
+    __slots__ = ()
+
+    def __new__(cls, min_price=None, max_price=None, min_quantity=None, max_quantity=None,
+                text=None, sort=()):
+        return super(ItemQuery, cls).__new__(cls, min_price, max_price, min_quantity,
+                                             max_quantity, text or None, tuple(sort))
+
+    def ranges(self):
+        """ Returns the columns the query narrows, most selective first """
+        ranges = []
+        if self.text:
+            ranges.append('text')
+        if self.min_price is not None or self.max_price is not None:
+            ranges.append('price')
+        if self.min_quantity is not None or self.max_quantity is not None:
+            ranges.append('quantity')
+        return ranges
+
+    @property
+    def sorted(self):
+        """ Whether the items are in another order than by id """
+        return self.sort not in ((), (('id', False),))
+
+    def conditions(self, model):
+        """ Returns the conditions of the filters on the columns of a model """
+        conditions = []
+        for column, low, high in ((model.price, self.min_price, self.max_price),
+                                  (model.quantity, self.min_quantity, self.max_quantity)):
+            if low is not None:
+                conditions.append(column >= low)
+            if high is not None:
+                conditions.append(column <= high)
+        if self.text:
+            # LIKE matches under the collation of the column, which a range
+            # of texts only does under a binary one
+            conditions.append(model.text.like(escape_like(self.text) + '%', escape=LIKE_ESCAPE))
+        return conditions
+
+    def order_by(self, model):
+        """ Returns the order of the sort keys, ties broken by id, on the columns of a model
+
+        The ids go the way of the last key, so an index ending with that
+        key, which also holds the id, gives the whole order when read
+        forwards or backwards.
+        """
+        order = []
+        for name, descending in self.sort:
+            column = getattr(model, name)
+            order.append(column.desc() if descending else column)
+        if 'id' not in [name for name, _ in self.sort]:
+            descending = self.sort[-1][1] if self.sort else False
+            order.append(model.id.desc() if descending else model.id)
+        return order
+
+
+def escape_like(text):
+    """ Returns a text with the LIKE wildcards in it escaped with LIKE_ESCAPE """
+    for character in (LIKE_ESCAPE, '%', '_'):
+        text = text.replace(character, LIKE_ESCAPE + character)
+    return text
+
+
+def parse_sort(sort):
+    """ Returns the sort keys of a comma separated list such as price,-quantity
+
+    Raises:
+        ValueError: for an unknown or repeated field or too many fields
+    """
+    keys = []
+    for name in (name.strip() for name in (sort or '').split(',')):
+        if not name:
+            continue
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name not in SORT_KEYS:
+            raise ValueError('Unknown sort field: {}. Fields are: {}'
+                             .format(name, ', '.join(SORT_KEYS)))
+        if name in [key for key, _ in keys]:
+            raise ValueError('Sort field {} is repeated'.format(name))
+        keys.append((name, descending))
+    if len(keys) > MAX_SORT_KEYS:
+        raise ValueError('Sort by at most {} fields'.format(MAX_SORT_KEYS))
+    return tuple(keys)
+
+
+def price(value):
+    """ Returns a price argument as a Decimal, raises ValueError unless it is a price """
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError('{} is not a price'.format(value))
+    if not amount.is_finite() or amount < 0:
+        raise ValueError('{} is not a price'.format(value))
+    return amount
+
+
+def plan(query, state=ADDED):
+    """ Returns the name of the index that serves a query best
+
+    Args:
+        query (ItemQuery): the filters and sort keys
+        state (int): the state of the items, every state when None
+    """
+    if state is None:
+        # past customer_id no index is in order without a state
+        return CUSTOMER_INDEX
+    first = query.sort[0][0] if query.sort else 'id'
+    ranges = query.ranges()
+    if first in ranges:
+        return RANGE_INDEXES[first]
+    if ranges:
+        return RANGE_INDEXES[ranges[0]]
+    if first in RANGE_INDEXES:
+        return RANGE_INDEXES[first]
+    # the active index only holds ADDED items on PostgreSQL and SQLite
+    return ACTIVE_INDEX if state == ADDED else CUSTOMER_INDEX
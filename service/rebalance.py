@@ -0,0 +1,164 @@
+"""
+Shard Rebalancing
+
+Moves every customer whose cart is not on the shard the ring places it on,
+while the service keeps serving it. To add a shard, append its URI to
+DATABASE_SHARD_URIS, restart the service with SHARD_REBALANCE_FROM set to the
+number of shards the data is on, then run with the same settings:
+
+    python -m service.rebalance --settle 1.0
+
+and unset SHARD_REBALANCE_FROM once it is done. A customer is moved in four
+steps:
+
+1. its cart row is written to the new shard with the MOVING version, from
+   then on the service reads the customer from the old shard and answers
+   writes with 503 Service Unavailable
+2. the tool waits --settle seconds for writes that started before to finish
+3. the items and the cart row are copied to the new shard in one
+   transaction that is only committed if the cart version on the old shard
+   did not change since it was read, the service reads the customer from
+   the new shard from then on
+4. the items and the cart row are deleted from the old shard
+
+A customer interrupted before step 3 is moved again on the next run, one
+interrupted after it only has its old rows deleted. Items get new ids on the
+new shard. Queued orders stay where they are, the dispatcher polls every
+shard.
+"""
+import sys
+import time
+import logging
+import argparse
+from sqlalchemy import select, union
+from service.models import DB, Shopcart, Cart
+from service.shards import MOVING
+
+logger = logging.getLogger('flask.app')
+
+ITEMS = Shopcart.__table__
+CARTS = Cart.__table__
+
+
+def _version(connection, customer_id):
+    return connection.execute(select([CARTS.c.version])
+                              .where(CARTS.c.customer_id == customer_id)).scalar()
+
+
+def customers_on(engine):
+    """ Returns the ids of the customers with items or a cart version on a shard """
+    query = union(select([ITEMS.c.customer_id]), select([CARTS.c.customer_id]))
+    with engine.connect() as connection:
+        return sorted(row[0] for row in connection.execute(query) if row[0] is not None)
+
+
+def plan(shards):
+    """ Returns a (customer_id, source, target) tuple for every customer to move """
+    moves = []
+    for name, engine in zip(shards.names, shards.engines):
+        for customer_id in customers_on(engine):
+            owner = shards.owner(customer_id)
+            if owner != name:
+                moves.append((customer_id, name, owner))
+    return moves
+
+
+def move_customer(source, target, customer_id, settle=1.0, sleep=time.sleep):
+    """ Moves the items and the cart row of a customer between two shards
+
+    Returns:
+        the number of items that were copied
+    """
+    rows = []
+    with target.begin() as connection:
+        version = _version(connection, customer_id)
+        moved = version is not None and version != MOVING
+        if not moved:
+            connection.execute(ITEMS.delete().where(ITEMS.c.customer_id == customer_id))
+            connection.execute(CARTS.delete().where(CARTS.c.customer_id == customer_id))
+            connection.execute(CARTS.insert(), customer_id=customer_id, version=MOVING)
+    if not moved:
+        sleep(settle)
+        while True:
+            with source.connect() as connection:
+                cart = connection.execute(select([CARTS])
+                                          .where(CARTS.c.customer_id == customer_id)).first()
+                version = cart.version if cart is not None else None
+                rows = [dict(row) for row in connection.execute(
+                    select([ITEMS]).where(ITEMS.c.customer_id == customer_id)
+                    .order_by(ITEMS.c.id))]
+            for row in rows:
+                del row['id']
+            with target.connect() as connection:
+                transaction = connection.begin()
+                connection.execute(ITEMS.delete().where(ITEMS.c.customer_id == customer_id))
+                if rows:
+                    connection.execute(ITEMS.insert(), rows)
+                connection.execute(CARTS.update().where(CARTS.c.customer_id == customer_id)
+                                   .values(version=version or 0,
+                                           item_count=cart.item_count if cart else 0,
+                                           subtotal=cart.subtotal if cart else 0))
+                with source.connect() as check:
+                    changed = _version(check, customer_id) != version
+                if changed:
+                    logger.info('Cart of customer %s changed while it was copied', customer_id)
+                    transaction.rollback()
+                    continue
+                transaction.commit()
+                break
+    with source.begin() as connection:
+        connection.execute(ITEMS.delete().where(ITEMS.c.customer_id == customer_id))
+        connection.execute(CARTS.delete().where(CARTS.c.customer_id == customer_id))
+    return len(rows)
+
+
+def rebalance(shards, settle=1.0, max_passes=10, sleep=time.sleep):
+    """ Moves customers until every one is on its shard
+
+    Customers created on their old shard during a pass are moved by the next
+    one.
+    Returns:
+        the number of customers and items moved and the passes it took
+    """
+    report = {'customers': 0, 'items': 0, 'passes': 0}
+    for _ in range(max_passes):
+        moves = plan(shards)
+        if not moves:
+            break
+        report['passes'] += 1
+        for customer_id, source, target in moves:
+            logger.debug('Moving customer %s from %s to %s', customer_id, source, target)
+            report['items'] += move_customer(shards.engine(source), shards.engine(target),
+                                             customer_id, settle, sleep)
+            report['customers'] += 1
+        logger.info('Rebalance pass %s moved %s customers', report['passes'], len(moves))
+    return report
+
+
+def main(argv=None):
+    """ Rebalances the shards of the configuration of the Flask app """
+    parser = argparse.ArgumentParser(description='Move customers to the shard the ring '
+                                                 'places them on')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds to wait for running writes after a cart is frozen')
+    parser.add_argument('--max-passes', type=int, default=10)
+    parser.add_argument('--dry-run', action='store_true', help='only log what would move')
+    args = parser.parse_args(argv)
+
+    from service import create_app
+    create_app()
+    if not DB.shards or DB.shards.previous is None:
+        parser.error('set DATABASE_SHARD_URIS and SHARD_REBALANCE_FROM, the number of shards '
+                     'the data is on, for the service and for the rebalance')
+    if args.dry_run:
+        for customer_id, source, target in plan(DB.shards):
+            logger.info('Customer %s would move from %s to %s', customer_id, source, target)
+        return 0
+    report = rebalance(DB.shards, args.settle, args.max_passes)
+    logger.info('Moved %s customers with %s items in %s passes',
+                report['customers'], report['items'], report['passes'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
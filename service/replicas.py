@@ -0,0 +1,147 @@
+"""
+Read Replicas
+
+Sends read only queries to the databases in DATABASE_REPLICA_URIS and
+everything else to the primary in DATABASE_URI.
+
+Reads only go to a replica inside replica_read(), which picks the replicas
+round robin and skips a replica for REPLICA_RETRY_SECONDS after it failed a
+query, in which case the read runs again on the primary. A session that
+has written goes on reading from the primary until it is removed at the
+end of the request, so a request always reads its own writes. A fresh()
+check run on the replica lets callers send the read to the primary when
+the replica has not caught up with the primary yet, e.g. with a write
+committed by an earlier request. Replicas are replicas of DATABASE_URI, reads
+of a sharded cart always go to its shard.
+"""
+import time
+import logging
+import threading
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm
+from sqlalchemy.sql.dml import UpdateBase
+from service.shards import ShardSet
+
+logger = logging.getLogger('flask.app')
+
+
+class ReplicaSet(object):
+    """ The replica engines, handed out round robin while they are healthy """
+
+    def __init__(self, engines, retry_after=30.0, clock=time.monotonic):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self.clock = clock
+        self._down_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, engine_options):
+        """ Creates an engine for every URI in DATABASE_REPLICA_URIS
+
+        Args:
+            config: the Flask config
+            engine_options: a function returning the engine options of a database URI
+        """
+        uris = [uri.strip() for uri in config.get('DATABASE_REPLICA_URIS', '').split(',')
+                if uri.strip()]
+        engines = [create_engine(uri, **engine_options(uri)) for uri in uris]
+        return cls(engines, config.get('REPLICA_RETRY_SECONDS', 30.0))
+
+    def __len__(self):
+        return len(self.engines)
+
+    def next(self):
+        """ Returns the next healthy replica, or None when there is none """
+        now = self.clock()
+        with self._lock:
+            for _ in range(len(self.engines)):
+                engine = self.engines[self._next % len(self.engines)]
+                self._next += 1
+                if self._down_until.get(engine, 0) <= now:
+                    return engine
+        return None
+
+    def mark_down(self, engine):
+        """ Skips a replica until retry_after seconds have passed """
+        with self._lock:
+            self._down_until[engine] = self.clock() + self.retry_after
+
+    def healthy(self):
+        """ Returns the replicas that are not skipped """
+        now = self.clock()
+        with self._lock:
+            return [engine for engine in self.engines if self._down_until.get(engine, 0) <= now]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+class RoutingSession(SignallingSession):
+    """ A session that reads from the replica in info['replica'] when one is set
+
+    Everything else goes to the shard in info['shard'], set by
+    service.shards.route(), or to the binds of Flask-SQLAlchemy.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        shard = self.info.get('shard')
+        if shard is not None:
+            return shard
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def execute(self, clause, params=None, mapper=None, bind=None, **kw):
+        # inserts, updates and deletes run as statements skip the flush
+        if isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        return SignallingSession.execute(self, clause, params, mapper, bind, **kw)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that can read from replicas and use shards """
+
+    replicas = ReplicaSet([])
+    shards = ShardSet([])
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _remember_write(session, flush_context):
+    session.info['wrote'] = True
+
+
+def replica_read(db, read, fresh=None):
+    """ Returns read() run on a replica, or on the primary when that is safer
+
+    The primary is used when there are no healthy replicas, when the session
+    has written, when fresh() run on the replica returns False or when the
+    replica fails.
+    """
+    session = db.session()
+    if session.info.get('wrote') or session.new or session.dirty or session.deleted \
+            or session.info.get('shard') is not None:
+        return read()
+    replica = db.replicas.next()
+    if replica is None:
+        return read()
+    session.info['replica'] = replica
+    try:
+        if fresh is not None and not fresh():
+            logger.info('Replica %s is behind the primary', replica.url)
+        else:
+            return read()
+    except exc.DBAPIError as error:
+        logger.warning('Replica %s failed, reading from the primary: %s',
+                       replica.url, str(error).splitlines()[0])
+        db.replicas.mark_down(replica)
+        session.rollback()
+    finally:
+        session.info.pop('replica', None)
+    return read()
@@ -1,8 +1,7 @@
 import os
-import sys
-import logging
-import requests
-from flask import Flask, jsonify, request, url_for, make_response, abort, json
+import hmac
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, json, \
+    stream_with_context
 from flask_api import status    # HTTP Status Codes
 from werkzeug.exceptions import NotFound
 from flask_restplus import Api, Resource, fields, reqparse, inputs
@@ -10,12 +9,19 @@ from flask_restplus import Api, Resource, fields, reqparse, inputs
 # SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Shopcart, DataValidationError, SHOPCART_ITEM_STAGE
+from sqlalchemy.exc import IntegrityError
+from service.models import DB, Shopcart, Cart, DataValidationError, StaleVersionError, \
+    ItemConflictError, CartMovingError, SHOPCART_ITEM_STAGE, SHOPCART_FIELDS
+from service import migrations, export, metrics, logs, pool, encoding, assets, query, \
+    compression
+from service.query import ItemQuery
 
 # Import Flask application
 from . import app
 
-ORDER_HOST_URL = "http://localhost:1234"
+MAX_BATCH_OPERATIONS = 500
+# the listing arguments that filter and sort the items, carried to the next page
+QUERY_ARGS = ('price', 'min_price', 'max_price', 'min_quantity', 'max_quantity', 'text', 'sort')
 
 
 ######################################################################
@@ -76,8 +82,8 @@ ORDER_HOST_URL = "http://localhost:1234"
 ######################################################################
 @app.route('/')
 def index():
-    """ Root URL response """
-    return app.send_static_file('index.html')
+    """ Root URL response, the index with fingerprinted links to the static files """
+    return assets.serve('index.html')
 
 ######################################################################
 # Configure Swagger
@@ -106,7 +112,10 @@ shopcart_model = api.model('Shopcart', {
     'text': fields.String(required=True,
                           description='Name of the product'),
     'state': fields.Integer(required=True,
-                            description='State of the product in shopcart.(ADDED:0 (Default), REMOVED:1, DONE:2)')
+                            description='State of the product in shopcart.(ADDED:0 (Default), REMOVED:1, DONE:2)'),
+    'version': fields.Integer(readOnly=True,
+                              description='Version of the item, send it back to only change the item '
+                                          'if no one else did since')
 })
 
 create_model = api.model('Shopcart', {
@@ -122,8 +131,90 @@ create_model = api.model('Shopcart', {
                               description='Name of the product')
 })
 
+operation_model = api.model('ShopcartOperation', {
+    'op': fields.String(required=True, enum=['add', 'update', 'remove'],
+                        description='Operation to apply to the item'),
+    'product_id': fields.Integer(required=True,
+                                 description='Product Identifier'),
+    'quantity': fields.Integer(required=False,
+                               description='Quantity of the product (add, update)'),
+    'price': fields.Float(required=False,
+                          description='Price (add)'),
+    'text': fields.String(required=False,
+                          description='Name of the product (add)'),
+    'version': fields.Integer(required=False,
+                              description='Only update the item at this version (update)')
+})
+
+increment_model = api.model('ShopcartIncrement', {
+    'delta': fields.Integer(required=True,
+                            description='Quantity to add to the item, negative to take away'),
+    'version': fields.Integer(required=False,
+                              description='Only change the item at this version')
+})
+
+summary_model = api.model('ShopcartSummary', {
+    'customer_id': fields.Integer(readOnly=True,
+                                  description='Customer Identifier'),
+    'item_count': fields.Integer(readOnly=True,
+                                 description='Quantity of the items in the cart'),
+    'subtotal': fields.String(readOnly=True,
+                              description='Sum of price * quantity of the items in the cart')
+})
+
 shopcart_args = reqparse.RequestParser()
-shopcart_args.add_argument('price', type=float, required=False, help='List shocpart items (cheapter than target_price if there exists one)')
+shopcart_args.add_argument('price', type=query.price, location='args', required=False,
+                           help='List shocpart items (cheapter than target_price if there exists one)')
+shopcart_args.add_argument('min_price', type=query.price, location='args', required=False,
+                           help='Lowest price of the items')
+shopcart_args.add_argument('max_price', type=query.price, location='args', required=False,
+                           help='Highest price of the items')
+shopcart_args.add_argument('min_quantity', type=inputs.natural, location='args', required=False,
+                           help='Lowest quantity of the items')
+shopcart_args.add_argument('max_quantity', type=inputs.natural, location='args', required=False,
+                           help='Highest quantity of the items')
+shopcart_args.add_argument('text', type=str, location='args', required=False,
+                           help='Prefix of the text of the items')
+shopcart_args.add_argument('sort', type=str, location='args', required=False,
+                           help='Comma separated fields to sort by, -field for descending, '
+                                'at most {}'.format(query.MAX_SORT_KEYS))
+shopcart_args.add_argument('limit', type=int, location='args', required=False,
+                           help='Most items in the page')
+shopcart_args.add_argument('after', type=int, location='args', required=False,
+                           help='Id of the last item of the previous page')
+shopcart_args.add_argument('fields', type=str, location='args', required=False,
+                           help='Comma separated fields to return for each item')
+shopcart_args.add_argument('state', type=str, location='args', required=False,
+                           help='State of the items to list, ADDED (0), REMOVED (1), DONE (2) '
+                                'or ALL, ADDED by default')
+
+export_args = reqparse.RequestParser()
+export_args.add_argument('format', choices=sorted(export.CONTENT_TYPES), location='args',
+                         default='ndjson', help='Output format: ndjson or csv')
+export_args.add_argument('state', type=int, location='args', required=False,
+                         help='Only export items in this state')
+export_args.add_argument('customer_from', type=int, location='args', required=False,
+                         help='Only export customers with this id or above')
+export_args.add_argument('customer_to', type=int, location='args', required=False,
+                         help='Only export customers with this id or below')
+export_args.add_argument('updated_since', type=inputs.datetime_from_iso8601, location='args',
+                         required=False, help='Only export items written at or after this time')
+
+@api.errorhandler(DataValidationError)
+def request_validation_error(error):
+    """ Handles an item the request body does not describe with 400_BAD_REQUEST """
+    app.logger.warning(str(error))
+    return {'message': str(error)}, status.HTTP_400_BAD_REQUEST
+
+@api.errorhandler(CartMovingError)
+def cart_moving(error):
+    """ Asks the client to retry a write to a cart that is moving to another shard """
+    app.logger.info(str(error))
+    return {'message': str(error)}, status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'}
+
+create_args = reqparse.RequestParser()
+create_args.add_argument('merge', type=inputs.boolean, location='args', required=False, default=False,
+                         help='Add the quantity to the item if it is already in the cart')
 
 ######################################################################
 # RETRIEVE; DELETE; UPDATE
@@ -136,16 +227,23 @@ class ShopcartItem(Resource):
     # Retrieve A Shopcart Item 
     #------------------------------------------------------------------
     @api.doc('get_shopcart_item')
+    @api.response(304, 'Item not modified since the ETag in If-None-Match')
     @api.response(404, 'Item not found')
     def get(self, customer_id, product_id):
         """
         Retrieve a single shop cart item
+
+        Answers 304 without reading the item when If-None-Match holds its current ETag
         """
         app.logger.info('Request for shopcart item with customer %s, product %s...',
                     customer_id, product_id)
-        item = Shopcart.find_by_customer_id_and_product_id(customer_id, product_id)
+        version = Cart.version_of(customer_id)
+        etag = cart_etag(customer_id, version, product_id)
+        if compression.etag_matches(request.if_none_match, etag):
+            return not_modified(etag)
+        item = Shopcart.find_item_on_replica(customer_id, product_id, version)
         if item:
-            return item.serialize(), status.HTTP_200_OK
+            return item.serialize(), status.HTTP_200_OK, cache_headers(etag)
         api.abort(status.HTTP_404_NOT_FOUND, "Product not in cart")
 
     #------------------------------------------------------------------
@@ -153,6 +251,8 @@ class ShopcartItem(Resource):
     #------------------------------------------------------------------
     @api.doc('shopcart_delete')
     @api.response(204,'Item deleted')
+    @api.response(409,'Item changed while it was deleted')
+    @api.response(412,'Cart changed since the ETag in If-Match')
     def delete(self, customer_id, product_id):
         """
         Delete an item from shopcart
@@ -162,10 +262,18 @@ class ShopcartItem(Resource):
         app.logger.info('Request to delete an existing shopcart item with customer id: %s and product_id: %s',
                     customer_id, product_id)
         cart_item = Shopcart.find_by_customer_id_and_product_id(customer_id, product_id)
+        expected_version = if_match_version(customer_id, product_id)
 
         if cart_item:
             app.logger.info('Found item with customer id and product id and it will be deleted')
-            cart_item.delete()
+            try:
+                cart_item.delete(expected_version=expected_version)
+            except ItemConflictError as error:
+                api.abort(status.HTTP_409_CONFLICT, str(error))
+            except StaleVersionError as error:
+                api.abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
+        elif request.if_match:
+            api.abort(status.HTTP_412_PRECONDITION_FAILED, 'Product not in cart')
         # should return 204 whether item is found or not found as discussed in class
         return make_response('', status.HTTP_204_NO_CONTENT)
 
@@ -175,23 +283,30 @@ class ShopcartItem(Resource):
     @api.doc('shopcart_update')
     @api.response(200,'Product Updated Successfully')
     @api.response(400,'Invalid Request')
+    @api.response(409,'Item changed since the version in the body')
+    @api.response(412,'Cart changed since the ETag in If-Match')
     @api.expect(shopcart_model)
     #@api.marshal_with(shopcart_model)
     def put(self, customer_id, product_id):
         """
         Update an item from shopcart
-        This endpoint will update a item for the selected product in the shopcart
+        This endpoint will update a item for the selected product in the shopcart.
+        With a version in the body the item is only updated if it is still at that version
         """
         app.logger.info('Request to update shopcart item with customer_id: %s, product_id: %s', customer_id, product_id)
         cart_item = Shopcart.find_by_customer_id_and_product_id(customer_id, product_id)
         
         if not cart_item:
             app.logger.info("Customer_id and product_id for update have not been found")
+            if request.if_match:
+                api.abort(status.HTTP_412_PRECONDITION_FAILED, 'Product not in cart')
             api.abort(status.HTTP_400_BAD_REQUEST, 'No product with id [{}] found for customer id [{}].'
                 .format(product_id,customer_id))
+        expected_version = if_match_version(customer_id, product_id)
 
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload
+        version = item_version(data)
         update_cart_item = Shopcart()
         update_cart_item.deserialize(data)
 
@@ -212,12 +327,62 @@ class ShopcartItem(Resource):
         cart_item.quantity = requested_quantity
         app.logger.info("cart_item.quantity = %s", cart_item.quantity)
         cart_item.state = SHOPCART_ITEM_STAGE['ADDED']
-        cart_item.save()
+        try:
+            cart_item.save(expected_version=expected_version, item_version=version)
+        except ItemConflictError as error:
+            app.logger.info('Item of customer %s changed since version %s', customer_id, version)
+            api.abort(status.HTTP_409_CONFLICT, str(error))
+        except StaleVersionError as error:
+            app.logger.info('Shopcart of customer %s changed since the If-Match ETag', customer_id)
+            api.abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
         app.logger.info('Quantity for customer id %s and product id %s has been updated',
                     customer_id, product_id)
-        return cart_item.serialize(), status.HTTP_200_OK
+        etag = cart_etag(customer_id, Cart.version_of(customer_id), product_id)
+        return cart_item.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(etag)}
         
 
+######################################################################
+# INCREMENT THE QUANTITY OF AN ITEM
+######################################################################
+@api.route('/shopcarts/<int:customer_id>/<int:product_id>/increment', strict_slashes=False)
+@api.param('customer_id','Customer Identifier')
+@api.param('product_id','Product Identifier')
+class ShopcartItemIncrement(Resource):
+    @api.doc('shopcart_increment')
+    @api.expect(increment_model)
+    @api.response(200, 'Quantity changed')
+    @api.response(400, 'Invalid delta or version')
+    @api.response(404, 'Product not in cart')
+    @api.response(409, 'Item changed since the version in the body, or the quantity would drop below 1')
+    @api.response(412, 'Cart changed since the ETag in If-Match')
+    def post(self, customer_id, product_id):
+        """
+        Adds to the quantity of an item
+
+        The quantity is changed by the database in one statement, so
+        concurrent increments never overwrite each other
+        """
+        app.logger.info('Request to increment product %s for customer %s', product_id, customer_id)
+        check_content_type('application/json')
+        data = api.payload
+        delta = data.get('delta') if isinstance(data, dict) else None
+        if not isinstance(delta, int) or isinstance(delta, bool):
+            api.abort(status.HTTP_400_BAD_REQUEST, 'delta must be an integer')
+        version = item_version(data)
+        expected_version = if_match_version(customer_id, product_id)
+        try:
+            item = Shopcart.increment(customer_id, product_id, delta, expected_version, version)
+        except ItemConflictError as error:
+            api.abort(status.HTTP_409_CONFLICT, str(error))
+        except StaleVersionError as error:
+            api.abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
+        if item is None:
+            if request.if_match:
+                api.abort(status.HTTP_412_PRECONDITION_FAILED, 'Product not in cart')
+            api.abort(status.HTTP_404_NOT_FOUND, 'Product not in cart')
+        etag = cart_etag(customer_id, Cart.version_of(customer_id), product_id)
+        return item.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(etag)}
+
 ######################################################################
 # CREATE; LIST; QUERY
 ######################################################################
@@ -225,54 +390,113 @@ class ShopcartItem(Resource):
 @api.param('customer_id','Customer Identifier')
 class ShopcartResource(Resource):
     @api.doc('create_item')
-    @api.expect(create_model)
+    @api.expect(create_model, create_args)
+    @api.response(200, 'Quantity merged into the item already in the cart')
     @api.response(400, "Coustomer id doesn't match")
     @api.response(409, 'Item already in the cart')
     def post(self, customer_id):
         """
         Creates a new item entry for the cart
+
+        With ?merge=true the quantity is added to the item instead of
+        returning 409 when the product is already in the cart. A product
+        that was removed or checked out is created again in place of its
+        old row
         """
         app.logger.info('Request to create shopcart item for costomer: %s', customer_id)
         check_content_type('application/json')
         if not customer_id == int(api.payload['customer_id']):
             app.logger.info("Coustomer id doesn't match")
             abort(400, description="Coustomer id doesn't match")
+        args = create_args.parse_args()
         product_id = api.payload['product_id']
-        if Shopcart.check_cart_exist(customer_id, product_id):
-            abort(409, description="Item already in the cart")
         shopcart = Shopcart()
         shopcart.deserialize(api.payload)
-        shopcart.save()
+        if not shopcart.create(merge_quantity=args['merge']):
+            if not args['merge']:
+                abort(409, description="Item already in the cart")
+            app.logger.info('Merged quantity into product %s for customer %s',
+                            product_id, customer_id)
+            return shopcart.serialize(), status.HTTP_200_OK
         location_url = api.url_for(ShopcartItem, customer_id = customer_id,
                                     product_id = product_id, _extrenal = True)
         return shopcart.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
     @api.doc('shopcart_list')
     @api.expect(shopcart_args, validate=True)
-    @api.marshal_list_with(shopcart_model)
+    @api.response(200, 'Success', [shopcart_model])
+    @api.response(304, 'Cart not modified since the ETag in If-None-Match')
+    @api.response(400, 'Invalid limit, fields, state, filter or sort')
     # @app.route('/shopcarts/<int:customer_id>', methods=['GET'])
     def get(self, customer_id):
-        """ Returns list of all of the shop cart items"""
-        if request.args.get('price') == None:
-            app.logger.info('Request to list all items in shopcart with customer_id: %s', customer_id)
-            items = []
-            items = Shopcart.find_by_customer_id(customer_id)
-            results = [item.serialize() for item in items]
-            #if results is None or len(results) == 0:
-            #    api.abort(404, "No items for this customer.")
-            return results, status.HTTP_200_OK
+        """ Returns a page of the shop cart items
 
+        Items are ordered by id and the Link header points to the next page.
+        Only the ADDED items are listed unless another state is asked for.
+        A listing sorted by other fields than id has a single page of up to limit items.
+        The items are written to JSON directly instead of being marshalled.
+        Answers 304 without reading the items when If-None-Match holds the current ETag
+        """
+        args = shopcart_args.parse_args()
+        limit = args['limit'] if args['limit'] is not None else app.config['PAGE_SIZE']
+        if not 1 <= limit <= app.config['MAX_PAGE_SIZE']:
+            api.abort(status.HTTP_400_BAD_REQUEST, 'limit must be between 1 and {}'
+                      .format(app.config['MAX_PAGE_SIZE']))
+        fields = parse_fields(args['fields'])
+        state = parse_state(args['state'])
+        item_query = parse_query(args)
+        if item_query.sorted and args['after'] is not None:
+            api.abort(status.HTTP_400_BAD_REQUEST, 'after only pages through items sorted by id')
+        version = Cart.version_of(customer_id)
+        etag = cart_etag(customer_id, version)
+        if compression.etag_matches(request.if_none_match, etag):
+            return not_modified(etag)
+        if item_query == ItemQuery() and args['after'] is None and fields is None and \
+                state == SHOPCART_ITEM_STAGE['ADDED']:
+            app.logger.info('Request to list all items in shopcart with customer_id: %s', customer_id)
+            _, results, cursor = Shopcart.serialize_cart(customer_id, version, limit)
         else:
-            target_price = request.args.get('price')
-            print(target_price)
             app.logger.info('Request to query all items in shopcart with customer_id: %s', customer_id)
-            items = []
-            items = Shopcart.query_by_target_price(customer_id, target_price)
-            results = [item.serialize() for item in items]
-            print(results)
-            #if results is None or len(results) == 0:
-            #    api.abort(404, "No items for this customer.")
-            return results, status.HTTP_200_OK
+            results, cursor = Shopcart.find_page_on_replica(customer_id, version, limit,
+                                                            args['after'], fields,
+                                                            None, state, item_query)
+        headers = cache_headers(etag)
+        if cursor is not None:
+            filters = {name: args[name] for name in QUERY_ARGS if args[name] is not None}
+            next_url = api.url_for(ShopcartResource, customer_id=customer_id, limit=limit,
+                                   after=cursor, fields=args['fields'], state=args['state'],
+                                   _external=True, **filters)
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        return json_response(encoding.encode_items(results, fields or SHOPCART_FIELDS),
+                             headers)
+
+    @api.doc('batch_items')
+    @api.expect([operation_model])
+    @api.response(200, 'Batch applied, see the status of each operation')
+    @api.response(400, 'Invalid request')
+    @api.response(409, 'Cart changed while the batch was applied')
+    def patch(self, customer_id):
+        """
+        Adds, updates and removes many items of the cart in one request
+
+        The operations are applied in order within a single transaction
+        and the result of every operation is returned in the same order
+        """
+        app.logger.info('Request to apply a batch to the shopcart of customer: %s', customer_id)
+        check_content_type('application/json')
+        operations = api.payload
+        if not isinstance(operations, list):
+            api.abort(status.HTTP_400_BAD_REQUEST, 'Body must be a list of operations')
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            api.abort(status.HTTP_400_BAD_REQUEST, 'A batch can have at most {} operations'
+                      .format(MAX_BATCH_OPERATIONS))
+        try:
+            results = Shopcart.apply_batch(customer_id, operations)
+        except (IntegrityError, StaleVersionError):
+            app.logger.info('Shopcart of customer %s changed during the batch', customer_id)
+            api.abort(status.HTTP_409_CONFLICT, 'Cart changed while the batch was applied, '
+                      'nothing was saved')
+        return results, status.HTTP_200_OK
 
 ######################################################################
 # MOVE A SHOPCART ITEM TO CHECKOUT
@@ -286,6 +510,7 @@ class ShopcartCheckout(Resource):
 
     @api.doc('shopcart_checkout')
     @api.response(400,'Invalid request params')
+    @api.response(409,'Item changed during the checkout')
     @api.response(200,'Product moved to Order Successfully')
     def put(self,customer_id,product_id):
         """
@@ -302,26 +527,103 @@ class ShopcartCheckout(Resource):
                 .format(product_id,customer_id))
             #return make_response(jsonify(message='Invalid request params'), status.HTTP_400_BAD_REQUEST)
 
+        # the order is queued with the state change and delivered by service.dispatcher
         try:
-            post_url = "{}/orders".format(ORDER_HOST_URL)
-            request_data = {}
-            request_data['customer_id'] = cart_item.customer_id
-            request_data['product_id'] = cart_item.product_id
-            request_data['price'] = cart_item.price
-            request_data['quantity'] = cart_item.quantity
-            response = requests.post(url=post_url, json=request_data)
-            app.logger.info("Product with id %s for customer id %s moved from shopcart to order",
-                            cart_item.product_id, cart_item.customer_id)
-        except Exception as ex:
-            app.logger.error("Something went wrong while moving product from shopcart to order %s", ex)
-
-        cart_item.state = SHOPCART_ITEM_STAGE['DONE']
-        cart_item.save()
+            cart_item.checkout()
+        except ItemConflictError as error:
+            api.abort(status.HTTP_409_CONFLICT, str(error))
         app.logger.info('Shopcart with product id %s and customer id %s moved to checkout',
                         product_id, customer_id)
         return make_response(jsonify(message="Product moved to Order Successfully",
                                      data=cart_item.serialize()), status.HTTP_200_OK)
 
+######################################################################
+# MOVE THE WHOLE SHOPCART TO CHECKOUT
+######################################################################
+
+@api.route('/shopcarts/<int:customer_id>/checkout', strict_slashes=False)
+@api.param('customer_id','Customer Identifier')
+class ShopcartCartCheckout(Resource):
+    # Move every item in the cart to order SHOPCART_ITEM_STAGE
+
+    @api.doc('shopcart_cart_checkout')
+    @api.response(400,'No items in the cart')
+    @api.response(200,'Cart moved to Order Successfully')
+    def put(self, customer_id):
+        """
+        Purchase all of the items in the shopcart
+
+        This endpoint will place one order for every item that is in the
+        shopcart and move them all to checkout together
+        """
+        app.logger.info('Request to move the cart of customer with id %s to checkout', customer_id)
+        items = Shopcart.checkout_cart(customer_id)
+        if not items:
+            app.logger.info("No items found in the cart of customer id %s", customer_id)
+            api.abort(status.HTTP_400_BAD_REQUEST, 'No items found in the cart of customer id [{}].'
+                .format(customer_id))
+        app.logger.info("%s products for customer id %s moved from shopcart to order",
+                        len(items), customer_id)
+        return make_response(jsonify(message="Cart moved to Order Successfully",
+                                     data=items), status.HTTP_200_OK)
+
+######################################################################
+# CART SUMMARY
+######################################################################
+
+@api.route('/shopcarts/<int:customer_id>/summary', strict_slashes=False)
+@api.param('customer_id','Customer Identifier')
+class ShopcartSummary(Resource):
+    @api.doc('shopcart_summary')
+    @api.response(200, 'Item count and subtotal of the cart', summary_model)
+    @api.response(304, 'Cart unchanged since the ETag in If-None-Match')
+    def get(self, customer_id):
+        """
+        Item count and subtotal of the items in the shopcart
+
+        Read from the cart row that every write to the cart keeps up to date
+        """
+        version, item_count, subtotal = Cart.summary_of(customer_id)
+        etag = cart_etag(customer_id, version)
+        if compression.etag_matches(request.if_none_match, etag):
+            return not_modified(etag)
+        return ({'customer_id': customer_id, 'item_count': item_count,
+                 'subtotal': str(subtotal)}, status.HTTP_200_OK, cache_headers(etag))
+
+######################################################################
+# EXPORT ALL SHOPCART ITEMS
+######################################################################
+@api.route('/admin/export', strict_slashes=False)
+class ShopcartExport(Resource):
+    # Stream every shopcart row for the analytics pipeline
+
+    @api.doc('shopcart_export')
+    @api.expect(export_args)
+    @api.produces(sorted(export.CONTENT_TYPES.values()))
+    @api.response(200, 'Rows streamed as NDJSON or CSV')
+    @api.response(401, 'Missing or wrong admin token')
+    def get(self):
+        """
+        Export all shopcart items
+
+        Rows are streamed in id order with chunked transfer encoding. When
+        ADMIN_TOKEN is set the request needs an Authorization: Bearer header
+        with it
+        """
+        token = app.config['ADMIN_TOKEN']
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                             'Bearer ' + token):
+            api.abort(status.HTTP_401_UNAUTHORIZED, 'Missing or wrong admin token')
+        args = export_args.parse_args()
+        app.logger.info('Request to export shopcart items with %s', args)
+        rows = export.query_rows(args['state'], args['customer_from'], args['customer_to'],
+                                 args['updated_since'], app.config['EXPORT_CHUNK_SIZE'])
+        chunks = export.generate(rows, args['format'], app.config['EXPORT_BUFFER_SIZE'])
+        return Response(stream_with_context(chunks),
+                        mimetype=export.CONTENT_TYPES[args['format']],
+                        headers={'Content-Disposition':
+                                 'attachment; filename=shopcarts.{}'.format(args['format'])})
+
 ######################################################################
 # DELETE ALL SHOPCART ITEMS FOR TESTING ONLY
 ######################################################################
@@ -331,14 +633,134 @@ def delete_cart_items():
     Shopcart.remove_all()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# CART CACHE STATISTICS
+######################################################################
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """ Returns the hit and miss counters of the cart cache """
+    return make_response(jsonify(Shopcart.cache.stats()), status.HTTP_200_OK)
+
+######################################################################
+# HEALTH CHECK
+######################################################################
+@app.route('/health', methods=['GET'])
+def health():
+    """ Returns the database round trip time and the use of the connection pool """
+    report = pool.health(DB.engine, app.config['DB_POOL_SATURATION'])
+    report['replicas'] = pool.replica_health(DB.replicas)
+    report['shards'] = pool.shard_health(DB.shards)
+    if any('error' in shard for shard in report['shards']) and report['status'] == 'ok':
+        report['status'] = 'degraded'
+    if report['status'] == 'failing':
+        app.logger.error('Health check failed: %s', report['database']['error'])
+        return make_response(jsonify(report), status.HTTP_503_SERVICE_UNAVAILABLE)
+    return make_response(jsonify(report), status.HTTP_200_OK)
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """ Returns the request and query metrics in the Prometheus text format """
+    data, content_type = metrics.exposition()
+    return make_response(data, status.HTTP_200_OK, {'Content-Type': content_type})
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-def init_db():
-    """ Initialies the SQLAlchemy app """
+def init_db(migrate=True):
+    """ Initialies the SQLAlchemy app, and creates or upgrades the schema when migrate is set """
     global app
     Shopcart.init_db(app)
+    if migrate:
+        migrations.upgrade_all()
+
+def cart_etag(customer_id, version, product_id=None):
+    """ Returns the ETag of a cart, or of one item in it, at a version """
+    if product_id is None:
+        return 'cart-{}-v{}'.format(customer_id, version)
+    return 'cart-{}-{}-v{}'.format(customer_id, product_id, version)
+
+def quote_etag(etag):
+    """ Returns an ETag as it is sent in a header """
+    return '"{}"'.format(etag)
+
+def cache_headers(etag):
+    """ Returns the headers that let clients revalidate a response with its ETag """
+    return {'ETag': quote_etag(etag), 'Cache-Control': 'private, no-cache'}
+
+def json_response(body, headers):
+    """ Returns a 200 OK response with a body that is already JSON """
+    return Response(body + '\n', status.HTTP_200_OK, headers, mimetype='application/json')
+
+def not_modified(etag):
+    """ Returns an empty 304 Not Modified response """
+    return make_response('', status.HTTP_304_NOT_MODIFIED, cache_headers(etag))
+
+def if_match_version(customer_id, product_id):
+    """ Returns the cart version the If-Match header of the request expects
+
+    Returns None when the request has no If-Match header or If-Match: *,
+    aborts with 412 when none of its ETags belongs to the item.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = cart_etag(customer_id, '', product_id)
+    for etag in request.if_match.as_set():
+        etag = compression.strip_encoding(etag)
+        version = etag[len(prefix):]
+        if etag.startswith(prefix) and version.isdigit():
+            return int(version)
+    api.abort(status.HTTP_412_PRECONDITION_FAILED, 'If-Match does not hold an ETag of this item')
+
+def item_version(data):
+    """ Returns the item version in a request body, None when it has none """
+    version = data.get('version') if isinstance(data, dict) else None
+    if version is not None and (not isinstance(version, int) or isinstance(version, bool)):
+        api.abort(status.HTTP_400_BAD_REQUEST, 'version must be an integer')
+    return version
+
+def parse_fields(fields):
+    """ Returns the list of field names in a fields argument or None for every field """
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SHOPCART_FIELDS]
+    if unknown or not names:
+        api.abort(status.HTTP_400_BAD_REQUEST, 'Unknown fields: {}. Fields are: {}'
+                  .format(', '.join(unknown), ', '.join(SHOPCART_FIELDS)))
+    return names
+
+def parse_state(state):
+    """ Returns the state in a state argument, ADDED when it is missing and None for ALL """
+    if not state:
+        return SHOPCART_ITEM_STAGE['ADDED']
+    name = state.strip().upper()
+    if name == 'ALL':
+        return None
+    if name in SHOPCART_ITEM_STAGE:
+        return SHOPCART_ITEM_STAGE[name]
+    if name.isdigit() and int(name) in SHOPCART_ITEM_STAGE.values():
+        return int(name)
+    api.abort(status.HTTP_400_BAD_REQUEST, 'Unknown state: {}. States are: {}, ALL'
+              .format(state, ', '.join(SHOPCART_ITEM_STAGE)))
+
+def parse_query(args):
+    """ Returns the filters and sort keys of the listing arguments
+
+    price is the highest price, as it was before max_price.
+    """
+    max_price = args['max_price']
+    if args['price'] is not None:
+        max_price = args['price'] if max_price is None else min(args['price'], max_price)
+    try:
+        sort = query.parse_sort(args['sort'])
+    except ValueError as error:
+        api.abort(status.HTTP_400_BAD_REQUEST, str(error))
+    return ItemQuery(args['min_price'], max_price, args['min_quantity'], args['max_quantity'],
+                     args['text'], sort)
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
@@ -347,23 +769,19 @@ def check_content_type(content_type):
     app.logger.error('Invalid Content-Type: %s', request.headers['Content-Type'])
     abort(415, 'Content-Type must be {}'.format(content_type))
 
-def initialize_logging(log_level=logging.INFO):
-    """ Initialized the default logging to STDOUT """
+def initialize_logging(log_level=None):
+    """ Initialized the default logging to STDOUT through a background thread """
     if not app.debug:
-        print('Setting up logging...')
-        # Set up default logging for submodules to use STDOUT
-        # datefmt='%m/%d/%Y %I:%M:%S %p'
-        fmt = '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
-        logging.basicConfig(stream=sys.stdout, level=log_level, format=fmt)
-        # Make a new log handler that uses STDOUT
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(logging.Formatter(fmt))
-        handler.setLevel(log_level)
-        # Remove the Flask default handlers and use our own
+        log_level = log_level or app.config['LOG_LEVEL']
+        logs.configure(log_level,
+                       log_format=app.config['LOG_FORMAT'],
+                       sample_rate=app.config['LOG_SAMPLE_RATE'],
+                       rate_limit=app.config['LOG_RATE_LIMIT'],
+                       queue_size=app.config['LOG_QUEUE_SIZE'])
+        # Remove the Flask default handlers, records go to the root logger's queue
         handler_list = list(app.logger.handlers)
         for log_handler in handler_list:
             app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
         app.logger.setLevel(log_level)
-        app.logger.propagate = False
+        app.logger.propagate = True
         app.logger.info('Logging handler established')
@@ -0,0 +1,149 @@
+"""
+Cart Shards
+
+Spreads the carts over the databases in DATABASE_SHARD_URIS by customer_id.
+The shards are named shard0, shard1, ... in the order they are listed and
+placed on a consistent hash ring with SHARD_VNODES points each, so adding a
+shard only moves the customers the ring hands to it. Every table of a
+customer (items, cart version, queued orders) lives on its shard, and item
+ids are only unique within a shard.
+
+The ring holds the first SHARD_COUNT shards (all of them when it is 0).
+While customers are moved by service.rebalance, SHARD_REBALANCE_FROM is the
+number of shards of the ring the data was placed with. A customer whose
+shard differs between the two rings is read from its old shard until its
+cart row shows up on the new one. While that row holds the MOVING version,
+writes to the customer raise CartMovingError.
+"""
+import bisect
+import hashlib
+from sqlalchemy import create_engine, select, table, column
+
+# the version of a cart that is being copied to its new shard
+MOVING = -1
+
+_carts = table('cart', column('customer_id'), column('version'))
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ A consistent hash ring of named nodes with vnodes points per node """
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = list(nodes)
+        points = sorted((_hash('{}#{}'.format(node, index)), node)
+                        for node in self.nodes for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        """ Returns the node that owns a key, or None when the ring is empty """
+        if not self._nodes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardSet(object):
+    """ The shard engines and the rings that place customers on them """
+
+    def __init__(self, engines, count=0, previous_count=0, vnodes=64):
+        self.engines = list(engines)
+        self.names = ['shard{}'.format(index) for index in range(len(self.engines))]
+        self.ring = HashRing(self.names[:count or len(self.names)], vnodes)
+        self.previous = HashRing(self.names[:previous_count], vnodes) if previous_count else None
+
+    @classmethod
+    def from_config(cls, config, engine_options):
+        """ Creates an engine for every URI in DATABASE_SHARD_URIS
+
+        Args:
+            config: the Flask config
+            engine_options: a function returning the engine options of a database URI
+        """
+        uris = [uri.strip() for uri in config.get('DATABASE_SHARD_URIS', '').split(',')
+                if uri.strip()]
+        engines = [create_engine(uri, **engine_options(uri)) for uri in uris]
+        return cls(engines, config.get('SHARD_COUNT', 0), config.get('SHARD_REBALANCE_FROM', 0),
+                   config.get('SHARD_VNODES', 64))
+
+    def __len__(self):
+        return len(self.engines)
+
+    def engine(self, name):
+        return self.engines[self.names.index(name)]
+
+    def owner(self, customer_id):
+        """ Returns the name of the shard the ring places a customer on """
+        return self.ring.node_for(customer_id)
+
+    def locate(self, customer_id):
+        """ Returns the shard holding a customer's cart and whether it is moving
+
+        Outside of a rebalance this is the owner on the ring without a query.
+        """
+        name = self.owner(customer_id)
+        if self.previous is None:
+            return name, False
+        previous = self.previous.node_for(customer_id)
+        if previous == name:
+            return name, False
+        with self.engine(name).connect() as connection:
+            version = connection.execute(select([_carts.c.version])
+                                         .where(_carts.c.customer_id == customer_id)).scalar()
+        if version is None:
+            return previous, False
+        if version == MOVING:
+            return previous, True
+        return name, False
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def route(db, customer_id):
+    """ Sends the queries of the session to the shard of a customer
+
+    Does nothing when there are no shards. The shard of a customer is looked
+    up once per session, which ends with the request, when the cart is on
+    the shard the ring places it on. A cart still on its previous shard
+    during a rebalance is looked up again every time, as it may move.
+    """
+    if not db.shards or customer_id is None:
+        return
+    session = db.session()
+    routes = session.info.setdefault('shard_routes', {})
+    if customer_id in routes:
+        name, moving = routes[customer_id]
+    else:
+        name, moving = db.shards.locate(customer_id)
+        if name == db.shards.owner(customer_id):
+            routes[customer_id] = (name, moving)
+    session.info['shard'] = db.shards.engine(name)
+    session.info['moving'] = moving
+
+
+def each_shard(db):
+    """ Yields the name of every shard with the session sent to it
+
+    Yields None once when there are no shards. Objects loaded from one shard
+    are detached before the next one, commit before moving on.
+    """
+    if not db.shards:
+        yield None
+        return
+    session = db.session()
+    try:
+        for index, name in enumerate(db.shards.names):
+            if index:
+                session.expunge_all()
+            session.info['shard'] = db.shards.engines[index]
+            session.info['moving'] = False
+            yield name
+    finally:
+        session.info.pop('shard', None)
+        session.info.pop('moving', None)
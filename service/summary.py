@@ -0,0 +1,138 @@
+"""
+Cart Summary Reconciliation
+
+Every write to a cart changes the item count and the subtotal on its cart
+row in the same transaction, so GET /shopcarts/<customer_id>/summary is a
+single primary key read. Writes that raced each other or rows changed
+outside of the service can still make a summary drift from the items. This
+job recomputes the summary of every cart from its ADDED items and repairs
+the rows that differ:
+
+    python -m service.summary --batch-size 500
+
+A repair bumps the cart version, so cached summaries and pages are
+revalidated, and only applies while the cart is still at the version the
+summary was computed at. A cart written meanwhile is checked on the next run.
+"""
+import sys
+import logging
+import argparse
+from decimal import Decimal
+from sqlalchemy import func, select
+from service.models import DB, Shopcart, Cart, SHOPCART_ITEM_STAGE, insert_if_absent
+from service.shards import MOVING, each_shard
+
+logger = logging.getLogger('flask.app')
+
+ITEMS = Shopcart.__table__
+CARTS = Cart.__table__
+CENT = Decimal('0.01')
+
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def customer_batches(session, batch_size=500):
+    """ Yields the ids of the customers with items or a cart row, batch_size at a time """
+    last = None
+    while True:
+        batch = set()
+        for column in (ITEMS.c.customer_id, CARTS.c.customer_id):
+            query = select([column]).where(column.isnot(None)).distinct()
+            if last is not None:
+                query = query.where(column > last)
+            batch.update(row[0] for row in
+                         session.execute(query.order_by(column).limit(batch_size)))
+        batch = sorted(batch)[:batch_size]
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+
+
+def expected_summaries(session, customer_ids):
+    """ Returns the item count and subtotal of the ADDED items of some customers """
+    rows = session.execute(
+        select([ITEMS.c.customer_id, func.sum(ITEMS.c.quantity),
+                func.sum(ITEMS.c.price * ITEMS.c.quantity)])
+        .where(ITEMS.c.customer_id.in_(customer_ids))
+        .where(ITEMS.c.state == SHOPCART_ITEM_STAGE['ADDED'])
+        .group_by(ITEMS.c.customer_id))
+    return {customer_id: (int(count or 0), _money(subtotal))
+            for customer_id, count, subtotal in rows}
+
+
+def reconcile_batch(session, customer_ids):
+    """ Repairs the summaries of some customers and commits, returns how many were repaired """
+    expected = expected_summaries(session, customer_ids)
+    stored = {row.customer_id: row for row in
+              session.execute(select([CARTS]).where(CARTS.c.customer_id.in_(customer_ids)))}
+    repaired = 0
+    for customer_id in customer_ids:
+        count, subtotal = expected.get(customer_id, (0, _money(0)))
+        row = stored.get(customer_id)
+        if row is None:
+            if count and insert_if_absent(session, CARTS,
+                                          {'customer_id': customer_id, 'version': 1,
+                                           'item_count': count, 'subtotal': subtotal},
+                                          ['customer_id']) is not None:
+                repaired += 1
+            continue
+        if row.version == MOVING or \
+                (row.item_count == count and _money(row.subtotal) == subtotal):
+            continue
+        logger.warning('Repairing the summary of customer %s: %s items for %s instead of %s '
+                       'for %s', customer_id, count, subtotal, row.item_count, row.subtotal)
+        result = session.execute(
+            CARTS.update()
+            .where(CARTS.c.customer_id == customer_id)
+            .where(CARTS.c.version == row.version)
+            .values(version=CARTS.c.version + 1, item_count=count, subtotal=subtotal))
+        repaired += result.rowcount
+    session.commit()
+    return repaired
+
+
+def reconcile(session, batch_size=500):
+    """ Repairs every summary of the database of a session
+
+    Returns:
+        the number of customers checked and repaired
+    """
+    report = {'checked': 0, 'repaired': 0}
+    for customer_ids in customer_batches(session, batch_size):
+        report['repaired'] += reconcile_batch(session, customer_ids)
+        report['checked'] += len(customer_ids)
+    return report
+
+
+def reconcile_all(batch_size=500):
+    """ Repairs the summaries of every shard """
+    report = {'checked': 0, 'repaired': 0}
+    for _ in each_shard(DB):
+        for key, value in reconcile(DB.session, batch_size).items():
+            report[key] += value
+    return report
+
+
+def main(argv=None):
+    """ Reconciles the summaries with the configuration of the Flask app """
+    parser = argparse.ArgumentParser(description='Repair cart summaries that drifted')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='customers checked per transaction')
+    args = parser.parse_args(argv)
+
+    from service import create_app
+    app = create_app()
+    with app.app_context():
+        try:
+            report = reconcile_all(args.batch_size)
+        finally:
+            DB.session.remove()
+    logger.info('Checked %s cart summaries, repaired %s', report['checked'], report['repaired'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
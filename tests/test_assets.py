@@ -0,0 +1,90 @@
+"""
+Test cases for the Static Assets
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+import os
+import re
+import gzip
+import shutil
+import tempfile
+from flask import Flask
+from werkzeug.exceptions import NotFound
+from flask_api import status    # HTTP Status Codes
+from service import create_app, assets
+
+SCRIPT = b'function add(a, b) { return a + b; }\n' * 100
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestAssets(unittest.TestCase):
+    """ Static Asset Tests """
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.folder, 'cache')
+        os.makedirs(os.path.join(self.folder, 'static', 'js'))
+        with open(os.path.join(self.folder, 'static', 'js', 'app.js'), 'wb') as script:
+            script.write(SCRIPT)
+        with open(os.path.join(self.folder, 'static', 'index.html'), 'w') as index:
+            index.write('<script src="static/js/app.js"></script>'
+                        '<img src="static/missing.png">')
+        self.static = assets.StaticAssets.build(os.path.join(self.folder, 'static'),
+                                                min_size=1024, max_age=60,
+                                                cache_dir=self.cache_dir)
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def send(self, name, headers=None):
+        with self.app.test_request_context(headers=headers or {}):
+            return self.static.send(name)
+
+    def test_fingerprinted_links(self):
+        """ Link the index to fingerprinted files cached for good """
+        html = self.static.files['index.html'].data.decode()
+        url = re.search(r'src="static/(js/app\.[0-9a-f]{12}\.js)"', html).group(1)
+        self.assertIn('src="static/missing.png"', html)
+        resp = self.send(url, {'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=60, immutable')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.get_data()), SCRIPT)
+        self.assertTrue(resp.headers['ETag'].endswith('-gzip"'))
+        self.assertNotEqual(self.send(url).headers['ETag'], resp.headers['ETag'])
+        resp = self.send('js/app.js')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(resp.get_data(), SCRIPT)
+        resp = self.send('js/app.js', {'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_small_and_missing(self):
+        """ Send small files uncompressed and 404 for unknown files """
+        resp = self.send('index.html', {'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.mimetype, 'text/html')
+        with self.assertRaises(NotFound):
+            self.send('js/other.js')
+
+    def test_compression_cache(self):
+        """ Reuse the files compressed by another worker """
+        digest = self.static.files['js/app.js'].digest
+        path = os.path.join(self.cache_dir, digest + '.gzip')
+        self.assertTrue(os.path.exists(path))
+        with open(path, 'wb') as cached:
+            cached.write(b'cached')
+        static = assets.StaticAssets.build(os.path.join(self.folder, 'static'),
+                                           cache_dir=self.cache_dir)
+        self.assertEqual(static.files['js/app.js'].encoded['gzip'], b'cached')
+
+    def test_service_index(self):
+        """ Serve the index of the service with fingerprinted links """
+        resp = create_app().test_client().get('/')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        self.assertRegex(resp.get_data(as_text=True), r'static/js/rest_api\.[0-9a-f]{12}\.js')
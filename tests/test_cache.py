@@ -0,0 +1,135 @@
+"""
+Test cases for the Cart Cache
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+import fnmatch
+from service.cache import LRUCache, RedisCache, NullCache, create_cache
+
+
+class FakeClock(object):
+    """ A clock that only moves when told to """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis(object):
+    """ An in-memory stand in for the parts of redis.Redis the cache uses """
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None):
+        self.data[name] = value.encode('utf-8')
+        self.expiry[name] = ex
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def scan_iter(self, match=None):
+        return [name for name in self.data if fnmatch.fnmatch(name, match)]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ In-process Cache Tests """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """ Return a cached value and count hits and misses """
+        self.assertIsNone(self.cache.get('cart:1'))
+        self.cache.set('cart:1', [{'id': 1}])
+        self.assertEqual(self.cache.get('cart:1'), [{'id': 1}])
+        stats = self.cache.stats()
+        self.assertEqual(stats['backend'], 'memory')
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['sets'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_expiry(self):
+        """ Expire a value after the TTL """
+        self.cache.set('cart:1', [])
+        self.clock.now = 9.9
+        self.assertEqual(self.cache.get('cart:1'), [])
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get('cart:1'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        self.cache.set('cart:1', [])
+        self.cache.set('cart:2', [])
+        self.cache.get('cart:1')
+        self.cache.set('cart:3', [])
+        self.assertIsNone(self.cache.get('cart:2'))
+        self.assertEqual(self.cache.get('cart:1'), [])
+        self.assertEqual(self.cache.get('cart:3'), [])
+
+    def test_delete_and_clear(self):
+        """ Invalidate values """
+        self.cache.set('cart:1', [])
+        self.cache.set('cart:2', [])
+        self.cache.delete('cart:1')
+        self.assertIsNone(self.cache.get('cart:1'))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('cart:2'))
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+
+class TestRedisCache(unittest.TestCase):
+    """ Redis Cache Tests """
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.cache = RedisCache(self.redis, ttl=10)
+
+    def test_get_and_set(self):
+        """ Store values as JSON with a TTL """
+        self.assertIsNone(self.cache.get('cart:1'))
+        self.cache.set('cart:1', [{'id': 1, 'price': '5.00'}])
+        self.assertEqual(self.redis.expiry['shopcart:cart:1'], 10)
+        self.assertEqual(self.cache.get('cart:1'), [{'id': 1, 'price': '5.00'}])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_delete_and_clear(self):
+        """ Invalidate values under the prefix only """
+        self.redis.set('other', 'keep')
+        self.cache.set('cart:1', [])
+        self.cache.set('cart:2', [])
+        self.cache.delete('cart:1')
+        self.assertIsNone(self.cache.get('cart:1'))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('cart:2'))
+        self.assertEqual(self.redis.get('other'), b'keep')
+
+
+class TestCreateCache(unittest.TestCase):
+    """ Cache Configuration Tests """
+
+    def test_backends(self):
+        """ Create the configured backend """
+        self.assertIsInstance(create_cache({}), LRUCache)
+        self.assertIsInstance(create_cache({'CACHE_BACKEND': 'none'}), NullCache)
+        self.assertRaises(RuntimeError, create_cache, {'CACHE_BACKEND': 'memcached'})
+
+    def test_null_cache(self):
+        """ Never return a value when caching is disabled """
+        cache = NullCache()
+        cache.set('cart:1', [])
+        self.assertIsNone(cache.get('cart:1'))
+        self.assertEqual(cache.stats()['misses'], 1)
@@ -0,0 +1,40 @@
+"""
+Test cases for the Item Encoding
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+import json
+from decimal import Decimal
+from service.encoding import encode_items, price_text
+from service.models import SHOPCART_FIELDS
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Item Encoding Tests """
+
+    def test_price_text(self):
+        """ Write prices with two decimals """
+        self.assertEqual(price_text(Decimal('12.5')), '12.50')
+        self.assertEqual(price_text(45.66), '45.66')
+        self.assertEqual(price_text('3'), '3.00')
+        self.assertIsNone(price_text(None))
+
+    def test_encode_items(self):
+        """ Write items as the JSON marshal() would """
+        items = [{'id': 1, 'product_id': 2, 'customer_id': 3, 'quantity': 4,
+                  'price': '12.50', 'text': 'say "hi" é\n', 'state': 0,
+                  'version': 1},
+                 {'customer_id': 3}]
+        text = encode_items(items, SHOPCART_FIELDS)
+        self.assertIn('"price":12.50', text)
+        data = json.loads(text)
+        self.assertEqual(data[0], dict(items[0], price=12.5))
+        self.assertEqual(data[1], dict(dict.fromkeys(SHOPCART_FIELDS), customer_id=3))
+        self.assertEqual(json.loads(encode_items(items[:1], ['quantity', 'text'])),
+                         [{'quantity': 4, 'text': 'say "hi" é\n'}])
+        self.assertEqual(encode_items([], SHOPCART_FIELDS), '[]')
@@ -0,0 +1,108 @@
+"""
+Test cases for the Structured Logging
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+import io
+import json
+import logging
+from service import app, create_app, logs, after_fork
+from service.service import initialize_logging
+
+
+class FakeClock(object):
+    """ A clock that only moves when told to """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_record(message, level=logging.INFO, args=None):
+    return logging.LogRecord('flask.app', level, __file__, 1, message, args, None)
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Structured Logging Tests """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        create_app()
+
+    def tearDown(self):
+        # put the logging of the service back
+        initialize_logging()
+
+    def test_json_formatter(self):
+        """ Format a record as one JSON object """
+        record = make_record('Deleting %s', args=(7,))
+        record.request_id = 'abc'
+        entry = json.loads(logs.JsonFormatter().format(record))
+        self.assertEqual(entry['message'], 'Deleting 7')
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['request_id'], 'abc')
+        self.assertTrue(entry['time'].endswith('Z'))
+
+    def test_rate_limit(self):
+        """ Keep a limited number of info records of a message per second """
+        clock = FakeClock()
+        sampling = logs.SamplingFilter(rate_limit=2, clock=clock)
+        kept = [sampling.filter(make_record('Saving %s')) for _ in range(4)]
+        self.assertEqual(kept, [True, True, False, False])
+        self.assertTrue(sampling.filter(make_record('Another message')))
+        self.assertTrue(sampling.filter(make_record('Saving %s', level=logging.WARNING)))
+        clock.now = 1.0
+        self.assertTrue(sampling.filter(make_record('Saving %s')))
+        self.assertEqual(sampling.dropped, 2)
+
+    def test_sampling(self):
+        """ Drop info records but never warnings when sampling """
+        sampling = logs.SamplingFilter(sample_rate=0.0)
+        self.assertFalse(sampling.filter(make_record('Saving %s')))
+        self.assertTrue(sampling.filter(make_record('Failed', level=logging.ERROR)))
+
+    def test_queue_full(self):
+        """ Drop records instead of blocking when the queue is full """
+        handler = logs.configure(queue_size=1, stream=io.StringIO())
+        logs.stop()
+        handler.handle(make_record('first'))
+        handler.handle(make_record('second'))
+        self.assertEqual(handler.dropped, 1)
+
+    def test_configure(self):
+        """ Write records from the listener thread with the request id """
+        stream = io.StringIO()
+        logs.configure(logging.INFO, stream=stream)
+        with app.test_request_context(headers={'X-Request-ID': 'req-1'}):
+            logs._start_request()
+            logging.getLogger('flask.app').info('Deleting %s', 7)
+        logging.getLogger('flask.app').debug('not written')
+        logs.stop()
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['message'], 'Deleting 7')
+        self.assertEqual(entries[0]['request_id'], 'req-1')
+
+    def test_after_fork(self):
+        """ Start a new listener without stopping the one of the parent """
+        listener = logs._listener
+        after_fork()
+        self.assertIsNot(logs._listener, listener)
+        self.assertTrue(logs._listener._thread.is_alive())
+        if listener is not None:
+            listener.stop()
+
+    def test_request_id_header(self):
+        """ Return the request id, taken from the request or generated """
+        client = app.test_client()
+        resp = client.get('/cache/stats', headers={'X-Request-ID': 'from-client'})
+        self.assertEqual(resp.headers['X-Request-ID'], 'from-client')
+        resp = client.get('/cache/stats', headers={'X-Request-ID': 'bad id'})
+        self.assertEqual(len(resp.headers['X-Request-ID']), 32)
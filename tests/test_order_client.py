@@ -0,0 +1,177 @@
+"""
+Test cases for the Order Service Client
+
+The client is tested against a stub order service running on a local port.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from service.order_client import OrderClient, OrderServiceError, CircuitBreaker, \
+    CircuitOpenError
+
+
+class StubOrderHandler(BaseHTTPRequestHandler):
+    """ Answers POST /orders with the next status in the server's script """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        server.orders.append(json.loads(self.rfile.read(length).decode('utf-8')))
+        server.clients.add(self.client_address)
+        code = server.script.pop(0) if server.script else 201
+        if server.delay:
+            time.sleep(server.delay)
+        body = json.dumps({'id': len(server.orders)}).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubOrderServer(ThreadingMixIn, HTTPServer):
+    """ A local order service that records the orders it receives """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubOrderHandler)
+        self.orders = []
+        self.clients = set()
+        self.script = []
+        self.delay = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class FakeClock(object):
+    """ A clock that only moves when told to """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestOrderClient(unittest.TestCase):
+    """ Order Service Client Tests """
+
+    def setUp(self):
+        self.server = StubOrderServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = OrderClient(self.server.url, connect_timeout=0.5, read_timeout=0.5,
+                                  retries=2, backoff_factor=0)
+
+    def tearDown(self):
+        self.client.close()
+        self._stop_server()
+
+    def _stop_server(self):
+        if self.thread.is_alive():
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+
+    def test_create_order(self):
+        """ Post an order to the order service """
+        result = self.client.create_order({'customer_id': 1, 'product_id': 2})
+        self.assertEqual(result, {'id': 1})
+        self.assertEqual(self.server.orders, [{'customer_id': 1, 'product_id': 2}])
+
+    def test_connection_is_reused(self):
+        """ Keep the connection to the order service alive between orders """
+        for product_id in range(5):
+            self.client.create_order({'customer_id': 1, 'product_id': product_id})
+        self.assertEqual(len(self.server.orders), 5)
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_retry_unavailable(self):
+        """ Retry an order while the order service is unavailable """
+        self.server.script = [503, 503]
+        result = self.client.create_order({'customer_id': 1})
+        self.assertEqual(result, {'id': 3})
+        self.assertEqual(len(self.server.orders), 3)
+
+    def test_retries_exhausted(self):
+        """ Give up after the retries are used """
+        self.server.script = [503, 503, 503]
+        self.assertRaises(OrderServiceError, self.client.create_order, {'customer_id': 1})
+        self.assertEqual(len(self.server.orders), 3)
+
+    def test_gateway_error_not_retried(self):
+        """ Don't retry an order a gateway may have passed on """
+        for code in (502, 504):
+            self.server.script = [code]
+            self.assertRaises(OrderServiceError, self.client.create_order, {'customer_id': 1})
+        self.assertEqual(len(self.server.orders), 2)
+
+    def test_rejected_order(self):
+        """ Don't retry an order the order service rejected """
+        self.server.script = [400]
+        self.assertRaises(OrderServiceError, self.client.create_order, {'customer_id': 1})
+        self.assertEqual(len(self.server.orders), 1)
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_read_timeout(self):
+        """ Stop waiting for a slow order service """
+        self.server.delay = 2
+        start = time.time()
+        self.assertRaises(OrderServiceError, self.client.create_order, {'customer_id': 1})
+        self.assertLess(time.time() - start, 1.5)
+        # a request that may have reached the order service is not sent again
+        self.assertEqual(len(self.server.orders), 1)
+
+    def test_connection_refused(self):
+        """ Fail when the order service is not running """
+        url = self.server.url
+        self._stop_server()
+        client = OrderClient(url, connect_timeout=0.5, retries=1, backoff_factor=0)
+        self.assertRaises(OrderServiceError, client.create_order, {'customer_id': 1})
+
+    def test_circuit_breaker_opens(self):
+        """ Stop calling the order service after repeated failures """
+        clock = FakeClock()
+        self.client = OrderClient(self.server.url, retries=0,
+                                  breaker=CircuitBreaker(failure_threshold=2,
+                                                         reset_timeout=10, clock=clock))
+        self.server.script = [500, 500]
+        self.assertRaises(OrderServiceError, self.client.create_order, {'customer_id': 1})
+        self.assertRaises(OrderServiceError, self.client.create_order, {'customer_id': 1})
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, self.client.create_order, {'customer_id': 1})
+        self.assertEqual(len(self.server.orders), 2)
+        # one trial call is let through once the reset timeout passed
+        clock.now = 10
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.client.create_order({'customer_id': 1}), {'id': 3})
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_trial_fails(self):
+        """ Open the breaker again when the trial call fails """
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        clock.now = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        clock.now = 15
+        self.assertFalse(breaker.allow())
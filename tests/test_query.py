@@ -0,0 +1,57 @@
+"""
+Test cases for the Cart Item Queries
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+from decimal import Decimal
+from service.query import ItemQuery, parse_sort, escape_like, price, plan
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestQuery(unittest.TestCase):
+    """ Cart Item Query Tests """
+
+    def test_parse_sort(self):
+        """ Read the sort keys and their direction """
+        self.assertEqual(parse_sort('price, -quantity'), (('price', False), ('quantity', True)))
+        self.assertEqual(parse_sort(None), ())
+        self.assertRaises(ValueError, parse_sort, 'secret')
+        self.assertRaises(ValueError, parse_sort, 'price,-price')
+        self.assertRaises(ValueError, parse_sort, 'id,price,quantity,text')
+
+    def test_escape_like(self):
+        """ Escape the LIKE wildcards of a text prefix """
+        self.assertEqual(escape_like('pen'), 'pen')
+        self.assertEqual(escape_like('50%_off\\'), '50\\%\\_off\\\\')
+
+    def test_price(self):
+        """ Take prices as decimals """
+        self.assertEqual(price('12.50'), Decimal('12.50'))
+        for value in ('abc', '-1', 'nan', 'Infinity'):
+            self.assertRaises(ValueError, price, value)
+
+    def test_sorted(self):
+        """ Tell a query in id order from a sorted one """
+        self.assertFalse(ItemQuery().sorted)
+        self.assertFalse(ItemQuery(sort=[('id', False)]).sorted)
+        self.assertTrue(ItemQuery(sort=[('id', True)]).sorted)
+        self.assertEqual(ItemQuery(text=''), ItemQuery())
+
+    def test_plan(self):
+        """ Pick the index of the range, then of the first sort key """
+        self.assertEqual(plan(ItemQuery()), 'ix_shopcart_customer_active')
+        self.assertEqual(plan(ItemQuery(), state=2), 'ix_shopcart_customer_id')
+        self.assertEqual(plan(ItemQuery(max_price=5), state=None), 'ix_shopcart_customer_id')
+        self.assertEqual(plan(ItemQuery(max_price=5)), 'ix_shopcart_customer_state_price')
+        self.assertEqual(plan(ItemQuery(min_quantity=2, text='p')),
+                         'ix_shopcart_customer_state_text')
+        self.assertEqual(plan(ItemQuery(min_price=1, min_quantity=2, sort=[('quantity', True)])),
+                         'ix_shopcart_customer_state_quantity')
+        self.assertEqual(plan(ItemQuery(sort=[('price', False)])),
+                         'ix_shopcart_customer_state_price')
+        self.assertEqual(plan(ItemQuery(sort=[('product_id', False)])),
+                         'ix_shopcart_customer_active')